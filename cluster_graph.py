@@ -12,6 +12,7 @@ clustering_path = os.path.join(os.getcwd(), "distance_based_clustering", "cluste
 sys.path.insert(3, clustering_path)
 import fungi
 from column_distance import *
+from distance_cache import DistanceCache
 from distance_based_clustering.clustering import hierarchical_clustering
 from distance_based_clustering.clustering import kmeans_hier_init
 from distance_based_clustering.clustering import kmeans_self_defined_dist
@@ -128,9 +129,17 @@ motif_generator = motif_graph.MotifGraphGenerator(dataset.mmm, base_dir_motifs)
 motif_generator.generate_motif_graphs()
 
 
-dm, idlist = dist_from_col.calculate_distance_matrix(
-    dataset, Euclidean_Distance, "expand", bg=[0.27, 0.23, 0.23, 0.27], average=np.mean
-)
+# pairwise alignments are kept on disk, so reruns only align the pairs they have not seen yet
+with DistanceCache("distance_cache.sqlite") as distance_cache:
+    dm, idlist = dist_from_col.calculate_distance_matrix(
+        dataset,
+        Euclidean_Distance,
+        "expand",
+        bg=[0.27, 0.23, 0.23, 0.27],
+        average=np.mean,
+        cache=distance_cache,
+    )
+    print(distance_cache)
 
 dataset_cc = dataset.cc
 print(dataset_cc)
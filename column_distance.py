@@ -1,9 +1,221 @@
 # This file contains functions that output a distance given two columns of a
 # positional count matrix.
+# Every column distance comes in two flavours: the original scalar version that compares two 4D vectors, and a
+# batched version (suffix _Batch) that compares whole stacks of columns in a single numpy call. The scalar
+# functions are thin wrappers around the batched ones.
 
 # Most of the methods come from this paper: https://genomebiology.biomedcentral.com/articles/10.1186/gb-2007-8-2-r24
 import numpy as np
-import math
+from scipy import fft
+from motif_matrix import PPM
+
+
+def _check_columns(cols, nonzero = False):
+    """
+    Vectorized precondition check for a stack of columns: every column should sum up to 1 (with the same tolerance as
+    math.isclose), and if [nonzero] is set, no entry should be 0.
+    Precondition:
+        cols: (..., 4) numpy array
+    """
+    assert np.isclose(cols.sum(axis = -1), 1, rtol = 1e-09, atol = 0).all()
+    if nonzero:
+        assert not (cols == 0).any()
+
+
+def _columns(cols, nonzero = False):
+    """
+    Return [cols] as a float numpy array. A validated PPM is trusted as it is (only its cached nonzero flag is looked
+    at); anything else goes through _check_columns.
+    """
+    if isinstance(cols, PPM):
+        if nonzero:
+            assert cols.nonzero
+        return cols.values
+    cols = np.asarray(cols, dtype = float)
+    _check_columns(cols, nonzero = nonzero)
+    return cols
+
+
+# Unchecked kernels: the batched distances below only validate their inputs and call these.
+
+def _euclidean(ppm1, ppm2):
+    diff = ppm1 - ppm2
+    return np.sqrt((diff * diff).sum(axis = -1))
+
+
+def _pearson(ppm1, ppm2):
+    numerator = np.sum((ppm1 - 0.25000001) * (ppm2 - 0.25000001), axis = -1)
+    denominator = np.sqrt(np.sum((ppm1 - 0.25000001) ** 2, axis = -1)
+                          * np.sum((ppm2 - 0.25000001) ** 2, axis = -1))
+    return 1 - numerator / denominator
+
+
+def _kullback_leibler(ppm1, ppm2):
+    return 0.5 * (np.sum(ppm1 * np.log(ppm1 / ppm2), axis = -1) + np.sum(ppm2 * np.log(ppm2 / ppm1), axis = -1))
+
+
+def _jensen_shannon(ppm1, ppm2):
+    m = (ppm1 + ppm2) / 2
+    d1m = np.sum(ppm1 * np.log(ppm1 / m), axis = -1)
+    d2m = np.sum(ppm2 * np.log(ppm2 / m), axis = -1)
+    return ((d1m + d2m) / 2) ** 0.5
+
+
+# Kernels on prepared motifs. Everything a distance needs from a single motif (logs, entropies, centered and
+# normalized columns, squared norms) is computed once by a _prepare_* function, and cached on the motif when it is a
+# PPM. Each prepared motif is a tuple of arrays that all run along the column axis, so the prepared forms of several
+# motifs can simply be concatenated (see block_column_table).
+# - KLD is then a plain dot product: 0.5 * sum((p - q) * (log p - log q)),
+# - the squared JSD is H(m) - (H(p) + H(q)) / 2, where only the mixture m = (p + q) / 2 needs fresh logs,
+# - Pearson is 1 - u . v on the pre-centered, pre-normalized columns u, v,
+# - Euclidean is sqrt(|p|^2 + |q|^2 - 2 p . q),
+# and the all-vs-all tables of the last two are a single matrix multiply.
+
+def _cached(cols, key, compute, nonzero = False):
+    # compute(values) for a stack of columns, read from / stored in the cache of a PPM
+    if isinstance(cols, PPM):
+        return cols.cached(key, compute)
+    return compute(_columns(cols, nonzero = nonzero))
+
+
+def _prepare_logs(cols):
+    def compute(values):
+        logs = np.log(values)
+        return values, logs, -np.sum(values * logs, axis = -1)
+    if isinstance(cols, PPM):
+        assert cols.nonzero
+        return cols.values, cols.log_values, cols.entropy
+    return compute(_columns(cols, nonzero = True))
+
+
+def _prepare_pearson(cols):
+    def compute(values):
+        centered = values - 0.25000001
+        return centered / np.sqrt(np.sum(centered ** 2, axis = -1, keepdims = True))
+    return (_cached(cols, "pearson_unit", compute),)
+
+
+def _prepare_euclidean(cols):
+    values = _columns(cols)
+    return values, _cached(cols, "squared_norm", lambda values: np.sum(values * values, axis = -1))
+
+
+def _kullback_leibler_prepared(cols1, cols2):
+    ppm1, log1, _ = cols1
+    ppm2, log2, _ = cols2
+    return 0.5 * np.sum((ppm1 - ppm2) * (log1 - log2), axis = -1)
+
+
+def _jensen_shannon_prepared(cols1, cols2):
+    ppm1, _, entropy1 = cols1
+    ppm2, _, entropy2 = cols2
+    m = (ppm1 + ppm2) / 2
+    entropy_m = -np.sum(m * np.log(m), axis = -1)
+    # the difference can round to a tiny negative number for (nearly) identical columns
+    return np.maximum(entropy_m - (entropy1 + entropy2) / 2, 0) ** 0.5
+
+
+def _pearson_prepared(cols1, cols2):
+    return 1 - np.sum(cols1[0] * cols2[0], axis = -1)
+
+
+def _euclidean_prepared(cols1, cols2):
+    return _euclidean(cols1[0], cols2[0])
+
+
+def _pearson_table(cols1, cols2):
+    return 1 - cols1[0] @ cols2[0].T
+
+
+def _euclidean_table(cols1, cols2):
+    ppm1, norm1 = cols1
+    ppm2, norm2 = cols2
+    squared = norm1[:, None] + norm2[None, :] - 2 * (ppm1 @ ppm2.T)
+    # the expansion loses precision for (nearly) identical columns, recompute those few pairs directly
+    i, j = np.nonzero(squared < 1e-6)
+    if len(i) > 0:
+        diff = ppm1[i] - ppm2[j]
+        squared[i, j] = (diff * diff).sum(axis = -1)
+    return np.sqrt(squared)
+
+
+def _broadcast_table(kernel):
+    # all-vs-all version of an aligned kernel on prepared motifs
+    def table(cols1, cols2):
+        return kernel(tuple(x[:, None] for x in cols1), tuple(x[None] for x in cols2))
+    return table
+
+
+def _is_prepared(ppm1, ppm2):
+    return isinstance(ppm1, PPM) or isinstance(ppm2, PPM)
+
+
+def _evaluate(batch, ppm1, ppm2, table = False):
+    """
+    Evaluate the batched distance [batch] on two stacks of columns, validating the inputs once. With [table] set,
+    ppm1 and ppm2 are n1 * 4 and n2 * 4 and every column of ppm1 is compared to every column of ppm2.
+    As soon as one of the inputs is a PPM, the distance runs on the prepared (cached) form of the motifs; plain arrays
+    go through the original formulas.
+    """
+    kernel, nonzero, prepare, prepared, prepared_table = _KERNELS[batch]
+    if _is_prepared(ppm1, ppm2):
+        cols1 = prepare(ppm1)
+        cols2 = prepare(ppm2)
+        if table:
+            return prepared_table(cols1, cols2)
+        return prepared(cols1, cols2)
+    ppm1 = _columns(ppm1, nonzero = nonzero)
+    ppm2 = _columns(ppm2, nonzero = nonzero)
+    if table:
+        ppm1 = ppm1[:, None, :]
+        ppm2 = ppm2[None, :, :]
+    return kernel(ppm1, ppm2)
+
+
+def Euclidean_Distance_Batch(ppm1, ppm2):
+    """
+      Batched Euclidean_Distance: evaluate the Euclidean Distance between all the aligned columns of two stacks of columns.
+      ppm1, ppm2: (n, 4) or (batch, n, 4) arrays (or anything that broadcasts against each other), each column sums up to 1,
+        or validated PPM objects
+      Return an array of column distances with the last axis reduced, e.g. shape (n,) or (batch, n).
+    """
+    # Precondition check, once for the whole stack (skipped for validated PPM objects)
+    return _evaluate(Euclidean_Distance_Batch, ppm1, ppm2)
+
+
+def Pearson_CC_Distance_Batch(ppm1, ppm2):
+    """
+      Batched Pearson_CC_Distance: return 1 - PCC for all the aligned columns of two stacks of columns.
+      ppm1, ppm2: (n, 4) or (batch, n, 4) arrays (or anything that broadcasts against each other), each column sums up to 1,
+        or validated PPM objects
+      Return an array of column distances with the last axis reduced, e.g. shape (n,) or (batch, n).
+    """
+    # Precondition check, once for the whole stack (skipped for validated PPM objects)
+    return _evaluate(Pearson_CC_Distance_Batch, ppm1, ppm2)
+
+
+def Kullback_Leibler_Distance_Batch(ppm1, ppm2):
+    """
+        Batched Kullback_Leibler_Distance: the symmetrized KLD for all the aligned columns of two stacks of columns.
+        Precondition:
+            ppm1, ppm2: (n, 4) or (batch, n, 4) arrays (or anything that broadcasts against each other) with non-zero
+            probability, each column sums up to 1, or validated PPM objects
+        Return an array of column distances with the last axis reduced, e.g. shape (n,) or (batch, n).
+    """
+    # Precondition check, once for the whole stack (skipped for validated PPM objects)
+    return _evaluate(Kullback_Leibler_Distance_Batch, ppm1, ppm2)
+
+
+def Jensen_Shannon_Distance_Batch(ppm1, ppm2):
+    """
+    Batched Jensen_Shannon_Distance for all the aligned columns of two stacks of columns.
+    Precondition:
+        ppm1, ppm2: (n, 4) or (batch, n, 4) arrays (or anything that broadcasts against each other) with non-zero
+        probability, each column sums up to 1, or validated PPM objects
+    Return an array of column distances with the last axis reduced, e.g. shape (n,) or (batch, n).
+    """
+    # Precondition check, once for the whole stack (skipped for validated PPM objects)
+    return _evaluate(Jensen_Shannon_Distance_Batch, ppm1, ppm2)
 
 
 def Euclidean_Distance(col1, col2):
@@ -11,12 +223,7 @@ def Euclidean_Distance(col1, col2):
       Evaluate the Euclidean Distance between two columns of the probability probability matrix (column sum = 1)
       col1, col2: a 4-dimension vector, the probabilities sum up to 1
     """
-    col1 = np.array(col1)
-    col2 = np.array(col2)
-    # Precondition check
-    assert math.isclose(col1.sum(),1)
-    assert math.isclose(col2.sum(),1)
-    return np.sqrt(((col1 - col2) * (col1 - col2)).sum())
+    return Euclidean_Distance_Batch(col1, col2)
 
 
 def Pearson_CC_Distance(col1, col2):
@@ -28,15 +235,7 @@ def Pearson_CC_Distance(col1, col2):
       The pseudocount for the average entry values ensures that we do not have 0 as 
       denominator. 
     """
-    col1 = np.array(col1)
-    col2 = np.array(col2)
-    # Precondition check
-    assert math.isclose(col1.sum(),1)
-    assert math.isclose(col2.sum(),1)
-    numerator = np.sum((col1 - 0.25000001) * (col2 - 0.25000001))
-    denominator = np.sqrt(np.sum((col1 - 0.25000001) ** 2)
-                          * np.sum((col2 - 0.25000001) ** 2))
-    return 1 - numerator / denominator
+    return Pearson_CC_Distance_Batch(col1, col2)
 
 
 def Kullback_Leibler_Distance(col1, col2):
@@ -47,14 +246,7 @@ def Kullback_Leibler_Distance(col1, col2):
         Precondition:
             col1, col2: a 4-dimension vector with non-zero probability, the probabilities sum up to 1
     """
-    col1 = np.array(col1)
-    col2 = np.array(col2)
-    # Precondition check
-    assert math.isclose(col1.sum(),1)
-    assert math.isclose(col2.sum(),1)
-    assert np.array(col1 == 0).sum() == 0
-    assert np.array(col2 == 0).sum() == 0
-    return 0.5 * (np.sum(col1 * np.log(col1 / col2)) + np.sum(col2 * np.log(col2 / col1)))
+    return Kullback_Leibler_Distance_Batch(col1, col2)
 
 
 def Jensen_Shannon_Distance(col1, col2):
@@ -64,14 +256,149 @@ def Jensen_Shannon_Distance(col1, col2):
     Precondition:
         col1, col2: a 4-dimension vector with non-zero probability, the probabilities sum up to 1
     """
-    col1 = np.array(col1)
-    col2 = np.array(col2)
-    # Precondition check
-    assert math.isclose(col1.sum(),1)
-    assert math.isclose(col2.sum(),1)
-    assert np.array(col1 == 0).sum() == 0
-    assert np.array(col2 == 0).sum() == 0
-    m = (col1 + col2) / 2
-    d1m = np.sum(col1 * np.log(col1 / m))
-    d2m = np.sum(col2 * np.log(col2 / m))
-    return ((d1m + d2m) / 2) ** 0.5
+    return Jensen_Shannon_Distance_Batch(col1, col2)
+
+
+# Map from each scalar column distance to its batched version. Motif comparisons look up the batched kernel here
+# and only fall back to calling the scalar function column by column for user-defined distances.
+BATCH_KERNELS = {
+    Euclidean_Distance: Euclidean_Distance_Batch,
+    Pearson_CC_Distance: Pearson_CC_Distance_Batch,
+    Kullback_Leibler_Distance: Kullback_Leibler_Distance_Batch,
+    Jensen_Shannon_Distance: Jensen_Shannon_Distance_Batch,
+}
+
+# Map from each batched distance to: its unchecked kernel on plain arrays, whether it needs non-zero probabilities,
+# how to prepare a motif, and its aligned / all-vs-all kernels on prepared motifs.
+_KERNELS = {
+    Euclidean_Distance_Batch: (_euclidean, False, _prepare_euclidean, _euclidean_prepared, _euclidean_table),
+    Pearson_CC_Distance_Batch: (_pearson, False, _prepare_pearson, _pearson_prepared, _pearson_table),
+    Kullback_Leibler_Distance_Batch: (_kullback_leibler, True, _prepare_logs, _kullback_leibler_prepared,
+                                      _broadcast_table(_kullback_leibler_prepared)),
+    Jensen_Shannon_Distance_Batch: (_jensen_shannon, True, _prepare_logs, _jensen_shannon_prepared,
+                                    _broadcast_table(_jensen_shannon_prepared)),
+}
+
+
+def batch_kernel(col_dist):
+    """
+    Return the batched version of the column distance [col_dist], or None if [col_dist] has no batched version
+    (e.g. a user-defined column distance). Batched functions map to themselves.
+    """
+    if col_dist in BATCH_KERNELS.values():
+        return col_dist
+    return BATCH_KERNELS.get(col_dist)
+
+
+def column_table(col_dist, ppm1, ppm2):
+    """
+    All-vs-all column distances between two motifs: return the (len1, len2) matrix whose entry [i][j] is
+    col_dist(ppm1[i], ppm2[j]). The whole table is computed in one broadcast when [col_dist] has a batched kernel.
+    Every ungapped alignment of the two motifs is a diagonal of this table: the columns of ppm2 aligned with ppm1 shifted
+    by [offset] are np.diagonal(table, -offset).
+    For PPM inputs, the Euclidean and Pearson tables come from a single matrix multiply on the cached, pre-centered /
+    pre-normalized columns.
+    Precondition:
+        col_dist: a column distance from this module (scalar or batched), or any function of two 4D vectors
+        ppm1/ppm2: n * 4 numpy matrix, each row represents a position, or a validated PPM
+    """
+    batch = batch_kernel(col_dist)
+    if batch is not None:
+        return _evaluate(batch, ppm1, ppm2, table = True)
+    ppm1 = np.asarray(ppm1, dtype = float)
+    ppm2 = np.asarray(ppm2, dtype = float)
+    return np.array([[col_dist(col1, col2) for col2 in ppm2] for col1 in ppm1], dtype = float).reshape(len(ppm1), len(ppm2))
+
+
+def block_column_table(col_dist, ppms1, ppms2):
+    """
+    Column distances between every column of a block of motifs and every column of another block of motifs, in one
+    call (one matrix multiply for Euclidean and Pearson distances). Each motif is prepared once (and the result cached
+    for PPM objects), then the prepared motifs of each block are stacked along the column axis.
+    Return (table, starts1, starts2): the table of motif a of [ppms1] against motif b of [ppms2], i.e.
+    column_table(col_dist, ppms1[a], ppms2[b]), is table[starts1[a]:starts1[a + 1], starts2[b]:starts2[b + 1]].
+    Precondition:
+        col_dist: a column distance from this module (scalar or batched), or any function of two 4D vectors
+        ppms1/ppms2: non-empty lists of n * 4 numpy matrices or validated PPM objects
+    """
+    starts1 = np.concatenate([[0], np.cumsum([len(ppm) for ppm in ppms1])])
+    starts2 = np.concatenate([[0], np.cumsum([len(ppm) for ppm in ppms2])])
+    batch = batch_kernel(col_dist)
+    if batch is None:
+        stacked1 = np.concatenate([np.asarray(ppm, dtype = float) for ppm in ppms1])
+        stacked2 = np.concatenate([np.asarray(ppm, dtype = float) for ppm in ppms2])
+        return column_table(col_dist, stacked1, stacked2), starts1, starts2
+    _, _, prepare, _, prepared_table = _KERNELS[batch]
+    cols1 = tuple(np.concatenate(parts) for parts in zip(*[prepare(ppm) for ppm in ppms1]))
+    cols2 = tuple(np.concatenate(parts) for parts in zip(*[prepare(ppm) for ppm in ppms2]))
+    return prepared_table(cols1, cols2), starts1, starts2
+
+
+def pair_scorer(col_dist, ppm1, ppm2):
+    """
+    Prepare two motifs once and return a function score(rows1, rows2) giving the distances between the columns
+    ppm1[rows1] and ppm2[rows2] (slices or index arrays selecting the same number of columns). This is for callers that
+    only need some of the column pairs, e.g. an early-abandoning alignment search, and want to fetch them in small
+    batches without validating or preparing the motifs again for every batch.
+    Precondition:
+        col_dist: a column distance from this module (scalar or batched), or any function of two 4D vectors
+        ppm1/ppm2: n * 4 numpy matrix, each row represents a position, or a validated PPM
+    """
+    batch = batch_kernel(col_dist)
+    if batch is None:
+        ppm1 = np.asarray(ppm1, dtype = float)
+        ppm2 = np.asarray(ppm2, dtype = float)
+        def score(rows1, rows2):
+            return np.array([col_dist(col1, col2) for col1, col2 in zip(ppm1[rows1], ppm2[rows2])], dtype = float)
+        return score
+    _, _, prepare, prepared, _ = _KERNELS[batch]
+    cols1 = prepare(ppm1)
+    cols2 = prepare(ppm2)
+    def score(rows1, rows2):
+        return prepared(tuple(x[rows1] for x in cols1), tuple(x[rows2] for x in cols2))
+    return score
+
+
+def diagonal_sums(table):
+    """
+    Sums of every diagonal of a (len1, len2) table, e.g. a column_table, ordered by offset i - j from -(len2 - 1) to
+    len1 - 1: entry k + len2 - 1 is the summed distance of the alignment in which position i of the first motif faces
+    position i - k of the second.
+    """
+    len1, len2 = table.shape
+    rows, cols = np.indices(table.shape)
+    return np.bincount((rows - cols + len2 - 1).ravel(), weights = table.ravel(), minlength = len1 + len2 - 1)
+
+
+def _pearson_diagonal_sums(ppm1, ppm2):
+    # 1 - u . v summed along a diagonal is its length minus the cross-correlation of the unit columns u and v
+    units1, = _prepare_pearson(ppm1)
+    units2, = _prepare_pearson(ppm2)
+    len1, len2 = len(units1), len(units2)
+    size = fft.next_fast_len(len1 + len2 - 1, real = True)
+    spectrum = np.sum(fft.rfft(units1, size, axis = 0) * fft.rfft(units2[::-1], size, axis = 0), axis = 1)
+    correlation = fft.irfft(spectrum, size)[:len1 + len2 - 1]
+    offsets = np.arange(-(len2 - 1), len1)
+    return np.minimum(len1, offsets + len2) - np.maximum(0, offsets) - correlation
+
+
+# Column distances whose diagonal sums decompose into a cross-correlation along the position axis. The Euclidean
+# distance does not: its square root is taken per column pair, so only its squared form would.
+_DIAGONAL_KERNELS = {
+    Pearson_CC_Distance_Batch: _pearson_diagonal_sums,
+}
+
+
+def fft_diagonal_sums(col_dist, ppm1, ppm2):
+    """
+    diagonal_sums(column_table(col_dist, ppm1, ppm2)), computed with real FFTs in O((len1 + len2) log(len1 + len2))
+    instead of building the len1 * len2 table.
+    Return None if [col_dist] has no such decomposition (only Pearson_CC_Distance has).
+    Precondition:
+        col_dist: a column distance from this module (scalar or batched), or any function of two 4D vectors
+        ppm1/ppm2: n * 4 numpy matrix, each row represents a position, or a validated PPM
+    """
+    kernel = _DIAGONAL_KERNELS.get(batch_kernel(col_dist))
+    if kernel is None:
+        return None
+    return kernel(ppm1, ppm2)
@@ -0,0 +1,28 @@
+from scipy import sparse
+from scipy.sparse import csgraph
+
+
+def connected_components(graph, idlist, cutoff = None):
+    """
+    Cluster the motifs of a sparse motif graph into its connected components. With a graph of all the neighbours
+    within a distance cutoff, these are the single-linkage clusters cut at that distance.
+    Returns the clusters as lists of motif ids, the largest first.
+    Precondition:
+        graph: a symmetric scipy.sparse matrix of distances, e.g. from neighbour_graph.neighbour_graph
+        idlist: the motif ids, in the order of the graph's rows
+        cutoff: None, or a number; only the edges of distance <= cutoff are followed
+    """
+    graph = sparse.csr_matrix(graph, copy = True)
+    assert graph.shape == (len(idlist), len(idlist))
+    # only the pattern of the followed edges matters, so that explicit zero distances are edges too
+    if cutoff is None:
+        graph.data[:] = 1
+    else:
+        graph.data = (graph.data <= cutoff).astype(float)
+        graph.eliminate_zeros()
+    ncomponents, labels = csgraph.connected_components(graph, directed = False)
+    clusters = [[] for _ in range(ncomponents)]
+    for motif_id, label in zip(idlist, labels):
+        clusters[label].append(motif_id)
+    clusters.sort(key = len, reverse = True)
+    return clusters
@@ -1,4 +1,5 @@
 import numpy as np
+from scipy import sparse
 import os
 
 
@@ -36,18 +37,29 @@ def wrap_dm(idlist, dm):
     helper functions to first wrap the motif idlist into a leaf list, and to convert the distance matrix into a distance map. 
     Precondition: 
         idlist: a list of motif ids. 
-        dm: a np array representing the distance matrix. it should have a shape of len(idlist) * len(idlist)
+        dm: a distance_matrix.DistanceMatrix, or a np array representing the distance matrix. it should have a shape of
+            len(idlist) * len(idlist). It can also be a sparse motif graph (a scipy.sparse matrix such as
+            neighbour_graph.neighbour_graph), whose absent edges are left out of the distance map (infinitely far).
     Returns:
         nodemap: a map of treenodes: treenode.name -> treenode
         distance_map: a map of treenode.name -> treenode.name -> distance
     """
     nodemap = {id : TreeNode(id, None, None, 0, 1) for id in idlist}
     distance_map = {}
+    if sparse.issparse(dm):
+        graph = dm.tocsr()
+        for i in range(len(idlist)):
+            edges = slice(graph.indptr[i], graph.indptr[i + 1])
+            id1_map = {idlist[j]: distance for j, distance in zip(graph.indices[edges], graph.data[edges])}
+            id1_map[idlist[i]] = 0
+            distance_map[idlist[i]] = id1_map
+        return nodemap, distance_map
     for i in range(len(idlist)):
         motif_id1 = idlist[i]
         id1_map = {}
+        row = dm[i]
         for j in range(len(idlist)):
-            id1_map[idlist[j]] = dm[i][j]
+            id1_map[idlist[j]] = row[j]
         distance_map[motif_id1] = id1_map
     return nodemap, distance_map
 
@@ -77,6 +89,9 @@ def tree_construction(dm, idlist, dc = "complete"):
     # need to build treenode for len(list(nodemap.keys()))-1 times
     for iter in range(len(list(nodemap.keys()))-1):
         m1, m2, sd = shortest(dm)
+        if m1 is None:
+            # only unconnected parts of a sparse graph are left: join two of them at an infinite height
+            m1, m2 = list(nodemap.keys())[:2]
         
         # create the new node and update the nodemap
         new_node_name = iter
@@ -96,10 +111,9 @@ def tree_construction(dm, idlist, dc = "complete"):
         del dm[m2]
         new_node_distances = {new_node_name : 0}
         for m in dm.keys():
-            distance_l = dm[m][m1]
-            distance_r = dm[m][m2]
-            del dm[m][m1]
-            del dm[m][m2]
+            # a sparse distance map has no entry for the pairs that are infinitely far
+            distance_l = dm[m].pop(m1, np.inf)
+            distance_r = dm[m].pop(m2, np.inf)
             if dc == "single":
                 new_distance = min(distance_l, distance_r)
             elif dc == "complete":
@@ -108,8 +122,9 @@ def tree_construction(dm, idlist, dc = "complete"):
                 new_distance = (distance_l * lmn + distance_r * rmn ) / mn
             elif dc == "WPGMA":
                 new_distance = (distance_l + distance_r) / 2
-            dm[m][new_node_name] = new_distance
-            new_node_distances[m] = new_distance
+            if new_distance < np.inf:
+                dm[m][new_node_name] = new_distance
+                new_node_distances[m] = new_distance
         dm[new_node_name] = new_node_distances
     assert len(list(nodemap.keys())) == 1
     return list(nodemap.values())[0]
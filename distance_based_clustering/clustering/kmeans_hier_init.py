@@ -1,5 +1,7 @@
 import random
 import numpy as np
+from scipy import sparse
+from distance_matrix import DistanceMatrix, GraphDistances
 
 class TreeNode(object):
     """
@@ -35,18 +37,29 @@ def wrap_dm(idlist, dm):
     helper functions to first wrap the motif idlist into a leaf list, and to convert the distance matrix into a distance map. 
     Precondition: 
         idlist: a list of motif ids. 
-        dm: a np array representing the distance matrix. it should have a shape of len(idlist) * len(idlist)
+        dm: a distance_matrix.DistanceMatrix, or a np array representing the distance matrix. it should have a shape of
+            len(idlist) * len(idlist). It can also be a sparse motif graph (a scipy.sparse matrix such as
+            neighbour_graph.neighbour_graph), whose absent edges are left out of the distance map (infinitely far).
     Returns:
         nodemap: a map of treenodes: treenode.name -> treenode
         distance_map: a map of treenode.name -> treenode.name -> distance
     """
     nodemap = {id : TreeNode(id, None, None, 0, 1) for id in idlist}
     distance_map = {}
+    if sparse.issparse(dm):
+        graph = dm.tocsr()
+        for i in range(len(idlist)):
+            edges = slice(graph.indptr[i], graph.indptr[i + 1])
+            id1_map = {idlist[j]: distance for j, distance in zip(graph.indices[edges], graph.data[edges])}
+            id1_map[idlist[i]] = 0
+            distance_map[idlist[i]] = id1_map
+        return nodemap, distance_map
     for i in range(len(idlist)):
         motif_id1 = idlist[i]
         id1_map = {}
+        row = dm[i]
         for j in range(len(idlist)):
-            id1_map[idlist[j]] = dm[i][j]
+            id1_map[idlist[j]] = row[j]
         distance_map[motif_id1] = id1_map
     return nodemap, distance_map
 
@@ -76,6 +89,9 @@ def tree_construction(dm, idlist, dc = "UPGMA"):
     # need to build treenode for len(list(nodemap.keys()))-1 times
     for iter in range(len(list(nodemap.keys()))-1):
         m1, m2, sd = shortest(dm)
+        if m1 is None:
+            # only unconnected parts of a sparse graph are left: join two of them at an infinite height
+            m1, m2 = list(nodemap.keys())[:2]
         
         # create the new node and update the nodemap
         new_node_name = iter
@@ -95,10 +111,9 @@ def tree_construction(dm, idlist, dc = "UPGMA"):
         del dm[m2]
         new_node_distances = {new_node_name : 0}
         for m in dm.keys():
-            distance_l = dm[m][m1]
-            distance_r = dm[m][m2]
-            del dm[m][m1]
-            del dm[m][m2]
+            # a sparse distance map has no entry for the pairs that are infinitely far
+            distance_l = dm[m].pop(m1, np.inf)
+            distance_r = dm[m].pop(m2, np.inf)
             if dc == "single":
                 new_distance = min(distance_l, distance_r)
             elif dc == "complete":
@@ -107,8 +122,9 @@ def tree_construction(dm, idlist, dc = "UPGMA"):
                 new_distance = (distance_l * lmn + distance_r * rmn ) / mn
             elif dc == "WPGMA":
                 new_distance = (distance_l + distance_r) / 2
-            dm[m][new_node_name] = new_distance
-            new_node_distances[m] = new_distance
+            if new_distance < np.inf:
+                dm[m][new_node_name] = new_distance
+                new_node_distances[m] = new_distance
         dm[new_node_name] = new_node_distances
     assert len(list(nodemap.keys())) == 1
     return list(nodemap.values())[0]
@@ -183,9 +199,9 @@ def select_initial_centroids(num_clusters, dm):
 
 def assign_clusters(centroids_indices, dm):
     clusters = [[] for _ in range(len(centroids_indices))]
-    for i, distances_to_centroids in enumerate(dm):
-        # Find the closest centroid for each motif
-        closest_centroid = np.argmin([dm[i][c] for c in centroids_indices])
+    # Find the closest centroid for each motif, reading only the centroids' columns of dm
+    distances_to_centroids = dm[np.ix_(np.arange(len(dm)), centroids_indices)]
+    for i, closest_centroid in enumerate(np.argmin(distances_to_centroids, axis = 1)):
         clusters[closest_centroid].append(i)
     return clusters
 
@@ -195,20 +211,22 @@ def find_new_centroids(clusters, dm):
         # Find the motif in the cluster that has the minimum average 
         # distance to all other motifs in the cluster
         if cluster:
-            min_avg_distance = float('inf')
-            centroid_index = None
-            for motif_index in cluster:
-                avg_distance = np.mean([dm[motif_index][other_index] for other_index in cluster])
-                if avg_distance < min_avg_distance:
-                    min_avg_distance = avg_distance
-                    centroid_index = motif_index
-            new_centroids_indices.append(centroid_index)
+            avg_distances = np.mean(dm[np.ix_(cluster, cluster)], axis = 1)
+            new_centroids_indices.append(cluster[np.argmin(avg_distances)])
     return new_centroids_indices
 
 def kmeans_motifs(dm, id_list, num_clusters, max_iter=100):
+    # the k-means iterations read a distance_matrix.DistanceMatrix block by block and a sparse motif graph through its
+    # edges (absent edges are infinitely far), nested lists are converted once. The hierarchical initialisation still
+    # loads every pairwise distance into memory, so only kmeans_self_defined_dist.kmeans_motifs suits a matrix file
+    # larger than the memory
+    if not isinstance(dm, DistanceMatrix) and not sparse.issparse(dm):
+        dm = np.asarray(dm)
     # Initialize centroids
     init_clusters_with_ids = hierarchical_clustering(num_clusters, dm, id_list)
     init_clusters = [[id_list.index(id) for id in ids] for ids in init_clusters_with_ids]
+    if sparse.issparse(dm):
+        dm = GraphDistances(dm)
     clusters = init_clusters
     centroids_indices = []
     
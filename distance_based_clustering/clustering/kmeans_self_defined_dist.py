@@ -1,5 +1,7 @@
 import random
 import numpy as np
+from scipy import sparse
+from distance_matrix import DistanceMatrix, GraphDistances
 
 def select_initial_centroids(num_clusters, dm):
     # Randomly choose 'num_clusters' different indices to serve as initial centroids
@@ -10,9 +12,9 @@ def select_initial_centroids(num_clusters, dm):
 
 def assign_clusters(centroids_indices, dm):
     clusters = [[] for _ in range(len(centroids_indices))]
-    for i, distances_to_centroids in enumerate(dm):
-        # Find the closest centroid for each motif
-        closest_centroid = np.argmin([dm[i][c] for c in centroids_indices])
+    # Find the closest centroid for each motif, reading only the centroids' columns of dm
+    distances_to_centroids = dm[np.ix_(np.arange(len(dm)), centroids_indices)]
+    for i, closest_centroid in enumerate(np.argmin(distances_to_centroids, axis = 1)):
         clusters[closest_centroid].append(i)
     return clusters
 
@@ -22,17 +24,17 @@ def find_new_centroids(clusters, dm):
         # Find the motif in the cluster that has the minimum average 
         # distance to all other motifs in the cluster
         if cluster:
-            min_avg_distance = float('inf')
-            centroid_index = None
-            for motif_index in cluster:
-                avg_distance = np.mean([dm[motif_index][other_index] for other_index in cluster])
-                if avg_distance < min_avg_distance:
-                    min_avg_distance = avg_distance
-                    centroid_index = motif_index
-            new_centroids_indices.append(centroid_index)
+            avg_distances = np.mean(dm[np.ix_(cluster, cluster)], axis = 1)
+            new_centroids_indices.append(cluster[np.argmin(avg_distances)])
     return new_centroids_indices
 
 def kmeans_motifs(dm, id_list, num_clusters, max_iter=100):
+    # a distance_matrix.DistanceMatrix is read block by block (it may be a file larger than the memory),
+    # a sparse motif graph through its edges (absent edges are infinitely far), nested lists are converted once
+    if not isinstance(dm, DistanceMatrix) and not sparse.issparse(dm):
+        dm = np.asarray(dm)
+    elif sparse.issparse(dm):
+        dm = GraphDistances(dm)
     # Initialize centroids
     centroids_indices = select_initial_centroids(num_clusters, dm)
     
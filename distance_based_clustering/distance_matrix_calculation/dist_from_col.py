@@ -1,15 +1,24 @@
 from Bio import motifs
+import json
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 sys.path.insert(1, "../CS4775_MC")
 import motif_distance
 from  column_distance import *
+from motif_matrix import PPMStore
+from distance_matrix import DistanceMatrix, TileLedger, condensed_index, header_path
 import numpy as np
 from scipy import stats
 
-def calculate_distance_matrix(dataset, col_dist, align_method, bg = [0.25,0.25,0.25,0.25], average = np.mean):
+def calculate_distance_matrix(dataset, col_dist, align_method, bg = [0.25,0.25,0.25,0.25], average = np.mean, block_size = 32,
+                              both_strands = False, cache = None, gap_settings = (0.5, 0.1, 3),
+                              min_overlap = 4, workers = 1, dtype = np.float64, path = None):
     """
-    Return the distance matrix of the whole dataset, calculated via column-wise distance measurement [col_dist] with [align_method]. 
+    Return (distance matrix, motif ids): the distance_matrix.DistanceMatrix of the whole dataset, calculated via
+    column-wise distance measurement [col_dist] with [align_method].
     If the alignment method is chosen to be "expand", the algorithm will calculate a threshold to see whether the minimum value
     really indicates a meaningful motif alignment. If not, the algorithm will return the mean distance of all possible alignments (as all are possible). 
     The column comparison scores are averaged via [average] function. 
@@ -19,34 +28,275 @@ def calculate_distance_matrix(dataset, col_dist, align_method, bg = [0.25,0.25,0
                 Kullback_Leibler_Distance, Jensen_Shannon_Distance, Euclidean_Distance, Pearson_CC_Distance,
             with Pearson_CC_Distance only available when bg is set not to be [0.25,0.25,0.25,0.25]. 
         bg: background frequency, represented by 4-D vectors that should sum to 1 (only expand_compare will use it)
-        alignment_method: ["expand","overlap"]
-        average: some average method that return a numerical value with a input list
+        alignment_method: ["expand","overlap","gapped","local"] ("gapped" only with average = np.mean, see
+            motif_distance.align)
+        average: some average method that return a numerical value with a input list, or the name of a
+            motif_distance Reducer ("mean", "median", "trimmed_mean", "ic_weighted_mean", "max")
+        block_size: the matrix is filled in tiles of block_size * block_size motifs. The column distances of a whole tile
+            come from one block_column_table call (a single matrix multiply for Euclidean and Pearson distances).
+        both_strands: if set, each pair is also compared with the second motif on the opposite strand and the smaller
+            distance is kept. The reverse complements join the column block of each tile, so both strands share its
+            table call.
+        cache: None, or a dict-like cache of motif_distance.AlignmentResult (see motif_distance.align), e.g. a persistent
+            distance_cache.DistanceCache. Pairs found in it are not aligned again (a tile whose pairs are all cached
+            skips its table call), and new pairs are added to it, so other callers sharing it can reuse them.
+        gap_settings: (gap_open, gap_extend, band) of the "gapped" alignment method
+        min_overlap: the minimum block length of the "local" alignment method
+        workers: number of processes filling the tiles. With workers > 1 the tiles are spread over a process pool whose
+            workers write straight into a shared-memory matrix (or into the file of [path]); every pair is computed by the same code on the same
+            tile table as in the serial run, so the result is bit-identical. col_dist and average then have to be
+            picklable (module-level functions or Reducers, not lambdas).
+        dtype: np.float64 or np.float32, the type of the stored distances
+        path: None (the matrix is held in memory), or a file the condensed matrix is written to as an np.memmap, tile
+            by tile, with its header in path + ".json" and a progress ledger in path + ".ledger". If that matrix
+            already exists (same motifs and settings), the calculation resumes from it: finished tiles are skipped and
+            the motifs keep the order of the file. The returned matrix is then backed by the file, so it can be
+            reopened later with DistanceMatrix.open(path) and clustered with kmeans_self_defined_dist.kmeans_motifs
+            without loading it into memory (the other clusterings load every pairwise distance).
     """
-    # Create a PWM for each motif and normalize it with pseudocounts
-    ppm_map = {
-        motif_id: motif.counts.normalize(pseudocounts=0.5) 
-        for motif_id, motif in dataset.mmm.items()
-    }
+    # The validated PPMs of the dataset (normalized with pseudocounts), built once per dataset and shared with the other
+    # modules, so that neither the conversion nor the column precondition checks are repeated for every pair
+    ppm_store = PPMStore.of(dataset, pseudocounts = 0.5)
 
     # Extract motif IDs for indexing
-    motif_ids = list(ppm_map.keys())
-
-    # Initialize the distance matrix with zeros
-    distance_matrix = np.zeros((len(motif_ids), len(motif_ids)))
-
-    # Calculate the Jensen-Shannon Divergence for each pair of motifs
-    for i, motif_id_1 in enumerate(motif_ids):
-        for j, motif_id_2 in enumerate(motif_ids):
-            if i < j:  # Since the matrix is symmetric, we only need to calculate once
-                ppm1 = np.array(list(ppm_map[motif_id_1].values())).T
-                ppm2 = np.array(list(ppm_map[motif_id_2].values())).T
-                # The first attribute could be:
-                # Kullback_Leibler_Distance
-                # Jensen_Shannon_Distance
-                # Euclidean_Distance
-                # average method could be:
-
-                distance = motif_distance.distance(col_dist, ppm1, ppm2,align_method, bg = bg, average = average)
-                distance_matrix[i][j] = distance_matrix[j][i] = distance
-
-    return distance_matrix.tolist(), motif_ids
\ No newline at end of file
+    motif_ids = list(ppm_store.ids)
+
+    metadata = _metadata(col_dist, align_method, bg, average, both_strands, gap_settings, min_overlap, block_size)
+    # Initialize the distance matrix with zeros, only its upper triangle is stored
+    ledger_mode = "w+"
+    if path is None:
+        distance_matrix = DistanceMatrix.zeros(motif_ids, dtype = dtype, metadata = metadata)
+    elif os.path.exists(header_path(path)):
+        distance_matrix = DistanceMatrix.open(path, mode = "r+")
+        assert sorted(distance_matrix.ids) == sorted(motif_ids), "%s holds the distances of other motifs" % path
+        assert distance_matrix.metadata == json.loads(json.dumps(metadata)), "%s was computed with other settings" % path
+        assert distance_matrix.condensed.dtype == np.dtype(dtype)
+        motif_ids = distance_matrix.ids
+        # only a resumed matrix may skip the tiles its ledger marks as finished
+        ledger_mode = "r+"
+    else:
+        distance_matrix = DistanceMatrix.create(path, motif_ids, dtype = dtype, metadata = metadata)
+
+    ppms = [ppm_store[motif_id] for motif_id in motif_ids]
+    settings = dict(col_dist = col_dist, align_method = align_method, bg = bg, average = average,
+                    both_strands = both_strands, gap_settings = gap_settings, min_overlap = min_overlap)
+    ledger = None
+    if path is not None and len(motif_ids) > 0:
+        ledger = TileLedger(path + ".ledger", len(_tile_bounds(len(motif_ids), block_size)), mode = ledger_mode)
+    _fill_matrix(distance_matrix, ppms, settings, block_size, cache, workers, ledger = ledger)
+
+    return distance_matrix, motif_ids
+
+
+def update_distance_matrix(distance_matrix, dataset, col_dist, align_method, bg = [0.25,0.25,0.25,0.25],
+                           average = np.mean, block_size = 32, both_strands = False, cache = None,
+                           gap_settings = (0.5, 0.1, 3), min_overlap = 4, workers = 1, path = None):
+    """
+    Return (distance matrix, motif ids) for the motifs of [dataset], reusing the distances of [distance_matrix]
+    (e.g. one saved by calculate_distance_matrix for a previous release, reopened with DistanceMatrix.open).
+    Motifs of [dataset] that are not in [distance_matrix] are added, motifs of [distance_matrix] that are not in
+    [dataset] are removed. Only the pairs involving an added motif are aligned: adding k motifs to n costs
+    k * n + k * (k - 1) / 2 alignments instead of (n + k) * (n + k - 1) / 2.
+    The kept motifs come first, in their order in [distance_matrix], followed by the added motifs in [dataset] order.
+    Motifs are identified by their ids: a motif whose counts changed under the same id keeps its old distances.
+    Preconditions:
+        distance_matrix: a distance_matrix.DistanceMatrix computed by calculate_distance_matrix with the same settings
+            (its metadata is checked, except for the block size)
+        the other arguments: see calculate_distance_matrix; [path] must not be the file of [distance_matrix]
+    """
+    metadata = _metadata(col_dist, align_method, bg, average, both_strands, gap_settings, min_overlap, block_size)
+    old_metadata = dict(distance_matrix.metadata, block_size = block_size)
+    assert old_metadata == json.loads(json.dumps(metadata)), "the distance matrix was computed with other settings"
+
+    old_index = {motif_id: i for i, motif_id in enumerate(distance_matrix.ids)}
+    kept = [i for i, motif_id in enumerate(distance_matrix.ids) if motif_id in dataset.mmm]
+    added = [motif_id for motif_id in dataset.mmm if motif_id not in old_index]
+    motif_ids = [distance_matrix.ids[i] for i in kept] + added
+    ppm_store = PPMStore.of(dataset, pseudocounts = 0.5)
+    ppms = [ppm_store[motif_id] for motif_id in motif_ids]
+
+    if path is None:
+        updated = DistanceMatrix.zeros(motif_ids, dtype = distance_matrix.condensed.dtype, metadata = metadata)
+    else:
+        updated = DistanceMatrix.create(path, motif_ids, dtype = distance_matrix.condensed.dtype, metadata = metadata)
+    # The kept block keeps its order, so each of its rows is one contiguous run of the new condensed vector
+    kept = np.array(kept, dtype = int)
+    n_old, n = len(distance_matrix), len(motif_ids)
+    for i in range(len(kept) - 1):
+        start = condensed_index(n, i, i + 1)
+        updated.condensed[start:start + len(kept) - 1 - i] = distance_matrix.condensed[
+            condensed_index(n_old, kept[i], kept[i + 1:])]
+
+    settings = dict(col_dist = col_dist, align_method = align_method, bg = bg, average = average,
+                    both_strands = both_strands, gap_settings = gap_settings, min_overlap = min_overlap)
+    _fill_matrix(updated, ppms, settings, block_size, cache, workers, first_new = len(kept))
+    updated.flush()
+
+    return updated, motif_ids
+
+
+def _metadata(col_dist, align_method, bg, average, both_strands, gap_settings, min_overlap, block_size):
+    # the settings of a distance matrix, as stored in its metadata (and checked when it is resumed or updated)
+    return dict(col_dist = getattr(col_dist, "__name__", repr(col_dist)), align_method = align_method,
+                bg = [float(value) for value in bg],
+                average = getattr(average, "name", getattr(average, "__name__", repr(average))),
+                both_strands = both_strands, gap_settings = list(gap_settings), min_overlap = min_overlap,
+                block_size = block_size)
+
+
+def _tile_bounds(n, block_size):
+    # (row_start, row_end, col_start, col_end) of the tiles on or above the diagonal of an n * n matrix
+    return [(row_start, min(row_start + block_size, n), col_start, min(col_start + block_size, n))
+            for row_start in range(0, n, block_size) for col_start in range(row_start, n, block_size)]
+
+
+def _fill_matrix(distance_matrix, ppms, settings, block_size, cache, workers, ledger = None, first_new = 0):
+    """
+    Compute the distances of [distance_matrix] between the motifs [ppms] tile by tile (see calculate_distance_matrix),
+    skipping the tiles finished in [ledger] (a distance_matrix.TileLedger or None) and the pairs whose motifs are both
+    before [first_new], which are already filled.
+    """
+    # Since the matrix is symmetric, we only need to calculate the tiles on or above the diagonal
+    tiles = []
+    tile_indices = []
+    for tile_index, (row_start, row_end, col_start, col_end) in enumerate(_tile_bounds(len(ppms), block_size)):
+        if col_end <= first_new or (ledger is not None and tile_index in ledger):
+            continue
+        pairs = [(i, j) for i in range(row_start, row_end) for j in range(max(i + 1, col_start, first_new), col_end)]
+        if cache is not None:
+            # pairs found in the cache are filled right away, a tile whose pairs are all cached is skipped
+            missing = []
+            for i, j in pairs:
+                key = motif_distance.alignment_key(**_key_settings(settings, ppms[i], ppms[j]))
+                result = None if key is None else cache.get(key)
+                if result is None:
+                    missing.append((i, j))
+                else:
+                    distance_matrix.set(i, j, result.distance)
+            pairs = missing
+        if pairs:
+            tiles.append((row_start, row_end, col_start, col_end, pairs))
+            tile_indices.append(tile_index)
+        elif ledger is not None:
+            distance_matrix.flush()
+            ledger.mark(tile_index)
+
+    if workers > 1 and len(tiles) > 1:
+        finished = _fill_tiles_parallel(ppms, settings, tiles, distance_matrix.condensed, workers, cache is not None)
+    else:
+        finished = (_fill_tile(ppms, settings, tile, distance_matrix.condensed, cache is not None) for tile in tiles)
+    # tiles are recorded as they finish, so that an interrupted run keeps them
+    for tile_index, tile_results in zip(tile_indices, finished):
+        if cache is not None:
+            for i, j, result in tile_results:
+                key = motif_distance.alignment_key(**_key_settings(settings, ppms[i], ppms[j]))
+                if key is not None:
+                    cache[key] = result
+        if ledger is not None:
+            distance_matrix.flush()
+            ledger.mark(tile_index)
+
+
+def _key_settings(settings, ppm1, ppm2):
+    # the arguments of motif_distance.alignment_key for one pair
+    return dict(settings, ppm1 = ppm1, ppm2 = ppm2)
+
+
+def _fill_tile(ppms, settings, tile, condensed, keep_results):
+    """
+    Align the [pairs] of one tile (row_start, row_end, col_start, col_end, pairs) and write their distances into the
+    [condensed] upper triangle of the distance matrix of [ppms]. The column distances of the whole tile come from one
+    block_column_table call.
+    Return the list of (i, j, AlignmentResult) if [keep_results] is set, else an empty list.
+    """
+    row_start, row_end, col_start, col_end, pairs = tile
+    col_dist = settings["col_dist"]
+    both_strands = settings["both_strands"]
+    col_block = ppms[col_start:col_end]
+    if both_strands:
+        col_block = col_block + [ppm.reverse_complement() for ppm in col_block]
+    table, starts1, starts2 = block_column_table(col_dist, ppms[row_start:row_end], col_block)
+    results = []
+    for i, j in pairs:
+        a = i - row_start
+        b = j - col_start
+        pair_table = table[starts1[a]:starts1[a + 1], starts2[b]:starts2[b + 1]]
+        if both_strands:
+            # the reverse complement of motif b sits one block further
+            b_reverse = b + col_end - col_start
+            pair_table = (pair_table, table[starts1[a]:starts1[a + 1], starts2[b_reverse]:starts2[b_reverse + 1]])
+        # The first attribute could be:
+        # Kullback_Leibler_Distance
+        # Jensen_Shannon_Distance
+        # Euclidean_Distance
+        # average method could be:
+        # np.mean, np.median, or any named motif_distance Reducer (scored over all offsets at once)
+
+        result = motif_distance.align(col_dist, ppms[i], ppms[j], settings["align_method"], bg = settings["bg"],
+                                      average = settings["average"], table = pair_table, both_strands = both_strands,
+                                      gap_settings = settings["gap_settings"], min_overlap = settings["min_overlap"])
+        condensed[condensed_index(len(ppms), i, j)] = result.distance
+        if keep_results:
+            results.append((i, j, result))
+    return results
+
+
+# state of a pool worker, set once by _init_worker
+_worker_state = {}
+
+
+def _init_worker(ppms, settings, memory_name, filename, shape, dtype, keep_results):
+    # the distances are either in a shared-memory block [memory_name] or in the np.memmap file [filename]
+    memory = None
+    if filename is not None:
+        condensed = np.memmap(filename, dtype = dtype, mode = "r+", shape = shape)
+    else:
+        memory = shared_memory.SharedMemory(name = memory_name)
+        condensed = np.ndarray(shape, dtype = dtype, buffer = memory.buf)
+    _worker_state.update(ppms = ppms, settings = settings, memory = memory, keep_results = keep_results,
+                         condensed = condensed)
+
+
+def _worker_tile(tile):
+    state = _worker_state
+    results = _fill_tile(state["ppms"], state["settings"], tile, state["condensed"], state["keep_results"])
+    if isinstance(state["condensed"], np.memmap):
+        state["condensed"].flush()
+    return results
+
+
+def _fill_tiles_parallel(ppms, settings, tiles, condensed, workers, keep_results):
+    """
+    Fill the tiles with a pool of [workers] processes. The workers write into one shared-memory copy of the
+    [condensed] distances (the tiles cover disjoint pairs), which is then copied back. Return the list of every tile's
+    results.
+    If [condensed] is an np.memmap, the workers write straight into its file instead (see _fill_tiles_in_file).
+    """
+    if isinstance(condensed, np.memmap):
+        return _fill_tiles_in_file(ppms, settings, tiles, condensed, workers, keep_results)
+    memory = shared_memory.SharedMemory(create = True, size = max(condensed.nbytes, 1))
+    try:
+        shared = np.ndarray(condensed.shape, dtype = condensed.dtype, buffer = memory.buf)
+        shared[:] = condensed
+        with ProcessPoolExecutor(max_workers = workers, initializer = _init_worker,
+                                 initargs = (ppms, settings, memory.name, None, condensed.shape, condensed.dtype,
+                                             keep_results)) as pool:
+            results = list(pool.map(_worker_tile, tiles))
+        condensed[:] = shared
+        del shared
+    finally:
+        memory.close()
+        memory.unlink()
+    return results
+
+
+def _fill_tiles_in_file(ppms, settings, tiles, condensed, workers, keep_results):
+    """
+    Fill the tiles of a file-backed matrix with a pool of [workers] processes that map the file of [condensed]
+    themselves. Yield every tile's results, in the order of [tiles], as soon as its distances are flushed to the file.
+    """
+    with ProcessPoolExecutor(max_workers = workers, initializer = _init_worker,
+                             initargs = (ppms, settings, None, condensed.filename, condensed.shape, condensed.dtype,
+                                         keep_results)) as pool:
+        for results in pool.map(_worker_tile, tiles):
+            yield results
@@ -1,28 +1,51 @@
-from Bio import motifs
-from scipy.spatial.distance import jensenshannon
 import numpy as np
+from column_distance import Jensen_Shannon_Distance, block_column_table
+from distance_matrix import DistanceMatrix
+from motif_matrix import PPMStore
+from distance_based_clustering.distance_matrix_calculation import dist_from_col
 
-def calculate_distance_matrix(dataset):
-    # Create a PWM for each motif and normalize it with pseudocounts
-    pwm_map = {
-        motif_id: motif.counts.normalize(pseudocounts=0.5) 
-        for motif_id, motif in dataset.mmm.items()
-    }
+def calculate_distance_matrix(dataset, align_method = "expand", bg = [0.25,0.25,0.25,0.25], block_size = 32, **kwargs):
+    """
+    Return (distance matrix, motif ids): the distance_matrix.DistanceMatrix of the Jensen-Shannon distance
+    (the square root of the Jensen-Shannon divergence, natural log, as scipy.spatial.distance.jensenshannon) between
+    the motifs of [dataset], averaged over the aligned columns.
+    The motifs are compared block_size * block_size at a time: the distances between all the columns of a block of
+    motifs come from one batched column_distance.block_column_table call, so no column pair is scored in Python.
+    Preconditions:
+        align_method: "expand" or "overlap" (and the other methods of dist_from_col.calculate_distance_matrix, which
+            does the alignments and takes the remaining keyword arguments), or "naive": the columns are compared from
+            the first position on and the longer motif is cut to the length of the shorter one, as this module used to
+            do with one scipy call per column
+        bg: background frequency, represented by 4-D vectors that should sum to 1 (only "expand" will use it)
+        block_size: positive integer
+    """
+    if align_method != "naive":
+        return dist_from_col.calculate_distance_matrix(dataset, Jensen_Shannon_Distance, align_method, bg = bg,
+                                                       block_size = block_size, **kwargs)
 
-    # Extract motif IDs for indexing
-    motif_ids = list(pwm_map.keys())
+    # The PPM of each motif normalized with pseudocounts, built once per dataset (n * 4, one row per position)
+    ppm_store = PPMStore.of(dataset, pseudocounts = 0.5)
+    ppms = ppm_store.ppms
+    motif_ids = list(ppm_store.ids)
+    n = len(motif_ids)
 
-    # Initialize the distance matrix with zeros
-    distance_matrix = np.zeros((len(motif_ids), len(motif_ids)))
+    # Initialize the distance matrix with zeros, only its upper triangle is stored
+    distance_matrix = DistanceMatrix.zeros(motif_ids, metadata = dict(col_dist = "Jensen_Shannon_Distance",
+                                                                      align_method = "naive"))
 
-    # Calculate the Jensen-Shannon Divergence for each pair of motifs
-    for i, motif_id_1 in enumerate(motif_ids):
-        for j, motif_id_2 in enumerate(motif_ids):
-            if i < j:  # Since the matrix is symmetric, we only need to calculate once
-                pwm1 = np.array(list(pwm_map[motif_id_1].values()))
-                pwm2 = np.array(list(pwm_map[motif_id_2].values()))
-                # Calculate JSD for each column and take the average
-                distance = np.mean([jensenshannon(col1, col2) for col1, col2 in zip(pwm1.T, pwm2.T)])
-                distance_matrix[i][j] = distance_matrix[j][i] = distance
+    # Since the matrix is symmetric, we only need to calculate the tiles on or above the diagonal
+    for row_start in range(0, n, block_size):
+        row_end = min(row_start + block_size, n)
+        for col_start in range(row_start, n, block_size):
+            col_end = min(col_start + block_size, n)
+            table, starts1, starts2 = block_column_table(Jensen_Shannon_Distance, ppms[row_start:row_end],
+                                                         ppms[col_start:col_end])
+            for i in range(row_start, row_end):
+                for j in range(max(i + 1, col_start), col_end):
+                    a = i - row_start
+                    b = j - col_start
+                    # the first positions of both motifs face each other, the rest of the longer one is ignored
+                    pair_table = table[starts1[a]:starts1[a + 1], starts2[b]:starts2[b + 1]]
+                    distance_matrix.set(i, j, np.mean(np.diagonal(pair_table)))
 
-    return distance_matrix.tolist(), motif_ids
\ No newline at end of file
+    return distance_matrix, motif_ids
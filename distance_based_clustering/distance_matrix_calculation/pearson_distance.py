@@ -1,37 +1,158 @@
-from Bio import motifs
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from distance_matrix import DistanceMatrix
+from column_distance import diagonal_sums
 
 
 """
-Return a motif-to-motif distance matrix as a 2D list, with a 1D list composed of motif ids 
+Return a motif-to-motif distance matrix as a distance_matrix.DistanceMatrix, with a 1D list composed of motif ids
 to indicate the motif's order in the distance matrix
 """
 
 
-def calculate_distance_matrix(dataset):
-    mmm = dataset.mmm
-    motif_ids = list(mmm.keys())
-
-    # pseudocount all the motifs before calculating the PSSM (position specific scoring matrix)
-    # Computes the root square of the total number of sequences multiplied by the background nucleotide.
-    # the background nucleotide frequency is uniform if not specified.
-    for motif_id in motif_ids:
-        mmm[motif_id].pseudocounts = motifs.jaspar.calculate_pseudocounts(
-            mmm[motif_id])
-
-    # generate a 2D matrix that denotes a distance matrix. The correspondance of the matrix
-    # index and the motif_ids is denoted with a list.
-    # pssm matrix is calculated log_2(P/P_background) for each position after the pseudocount is added.
-    mmd_matrix = []
-    for i in range(len(motif_ids)):
-        motif1 = motif_ids[i]
-        motif1_distances = []
-        for j in range(len(motif_ids)):
-            motif2 = motif_ids[j]
-            motif1_distances.append(
-                ((mmm[motif1].pssm).dist_pearson(mmm[motif2].pssm))[0])
-        mmd_matrix.append(motif1_distances)
-
-    return mmd_matrix, motif_ids
+def calculate_distance_matrix(dataset, block_size = 32, workers = 1):
+    """
+    Return (distance matrix, motif ids), the distance of motifs i and j being Biopython's
+    motifs[i].pssm.dist_pearson(motifs[j].pssm)[0] with the pseudocounts of motifs.jaspar.calculate_pseudocounts.
+    Only the upper triangle is computed, and the motifs of [dataset] are left untouched (Biopython's way needs their
+    pseudocounts to be set in place).
+    The pairs are scored block_size * block_size motifs at a time: the products of all the columns of two blocks of
+    PSSMs are one matrix multiply, and every offset of a pair is a diagonal of it (see sliding_pearson).
+    Preconditions:
+        block_size: positive integer
+        workers: number of processes scoring the blocks
+    """
+    store = PSSMStore(dataset.mmm)
+    motif_ids = list(store.ids)
+    n = len(motif_ids)
+    distance_matrix = DistanceMatrix.zeros(motif_ids, metadata = dict(col_dist = "dist_pearson", align_method = "pssm"))
+
+    # Since the matrix is symmetric, we only need to calculate the tiles on or above the diagonal
+    tiles = [(row_start, min(row_start + block_size, n), col_start, min(col_start + block_size, n))
+             for row_start in range(0, n, block_size) for col_start in range(row_start, n, block_size)]
+    if workers > 1 and len(tiles) > 1:
+        # the store is sent to every worker once, not with every tile
+        with ProcessPoolExecutor(max_workers = workers, initializer = _init_worker, initargs = (store,)) as pool:
+            finished = list(pool.map(_worker_tile, tiles))
+    else:
+        finished = [_score_tile(store, tile) for tile in tiles]
+    for tile_distances in finished:
+        for i, j, distance in tile_distances:
+            distance_matrix.set(i, j, distance)
+
+    return distance_matrix, motif_ids
+
+
+class PSSMStore(object):
+    """
+    The PSSMs (log2 odds against the motif background) of a motif set, as Biopython builds them for dist_pearson:
+    all the positions of all the motifs in one (total length) * 4 array, with the per-position sums and sums of
+    squares that every offset of a pair needs as prefix sums.
+    Attributes:
+        ids: list of the motif ids, in order
+        values: the (total length) * 4 array, motif n in values[offsets[n]:offsets[n] + lengths[n]]
+        offsets/lengths: int numpy arrays, the first position and the length of every motif
+        sums/squares: prefix sums over the positions of each motif (motif n in
+            sums[offsets[n] + n:offsets[n] + n + lengths[n] + 1], starting with 0)
+    """
+
+    def __init__(self, motifs):
+        """
+        Precondition:
+            motifs: non-empty dict motif id -> Bio.motifs.Motif over the alphabet ACGT
+        """
+        pssms = [_pssm(motif) for motif in motifs.values()]
+        self.ids = list(motifs.keys())
+        self.lengths = np.array([len(pssm) for pssm in pssms], dtype = int)
+        self.offsets = np.concatenate([[0], np.cumsum(self.lengths)[:-1]])
+        self.values = np.concatenate(pssms)
+        self.sums = np.concatenate([np.concatenate([[0], np.cumsum(pssm.sum(axis = 1))]) for pssm in pssms])
+        self.squares = np.concatenate([np.concatenate([[0], np.cumsum((pssm * pssm).sum(axis = 1))]) for pssm in pssms])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def pssm(self, n):
+        return self.values[self.offsets[n]:self.offsets[n] + self.lengths[n]]
+
+    def prefix_sums(self, n):
+        # (sums, squares) of motif n, each of length lengths[n] + 1
+        start = self.offsets[n] + n
+        return self.sums[start:start + self.lengths[n] + 1], self.squares[start:start + self.lengths[n] + 1]
+
+
+def _pssm(motif):
+    # the PSSM of Biopython's motif.pssm after motif.pseudocounts = motifs.jaspar.calculate_pseudocounts(motif),
+    # without setting it, as a length * 4 array in the order A, C, G, T
+    background = dict(motif.background) if motif.background else dict.fromkeys("ACGT", 1.0)
+    background = np.array([background[letter] for letter in "ACGT"], dtype = float)
+    background = background / background.sum()
+    counts = np.array([motif.counts[letter] for letter in "ACGT"], dtype = float).T
+    pseudocounts = np.sqrt(counts.sum() / len(counts)) * background
+    counts = counts + pseudocounts
+    return np.log2(counts / counts.sum(axis = 1, keepdims = True) / background)
+
+
+def sliding_pearson(store, n1, n2, table = None):
+    """
+    Biopython's dist_pearson of motif n1 of [store] against motif n2, for every offset at once: return (1 - the best
+    Pearson correlation, the offset of that alignment).
+    At the offset where position i of motif n1 faces position i - d of motif n2, the correlation is taken over the
+    4 * span entries of the whole span of the alignment (the overhangs count as zeros), from the sums over the
+    overlapping positions: the sums and sums of squares of each motif come from its prefix sums, and the sum of products
+    is diagonal d of the (len1, len2) table of position products pssm(n1) . pssm(n2)^T.
+    Ties are broken like Biopython, which tries the offsets -d from -(len1 - 1) up.
+    Precondition:
+        table: None, or the (len1, len2) table of position products (e.g. cut from the product of two blocks)
+    """
+    len1, len2 = store.lengths[n1], store.lengths[n2]
+    if table is None:
+        table = store.pssm(n1) @ store.pssm(n2).T
+    sums1, squares1 = store.prefix_sums(n1)
+    sums2, squares2 = store.prefix_sums(n2)
+    d = np.arange(-(len2 - 1), len1)
+    start1 = np.maximum(0, d)
+    end1 = np.minimum(len1, len2 + d)
+    norm = (np.maximum(len1, len2 + d) - np.minimum(0, d)) * 4
+    sx = (sums1[end1] - sums1[start1]) / norm
+    sy = (sums2[end1 - d] - sums2[start1 - d]) / norm
+    sxx = (squares1[end1] - squares1[start1]) / norm
+    syy = (squares2[end1 - d] - squares2[start1 - d]) / norm
+    sxy = diagonal_sums(table) / norm
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        pearson = (sxy - sx * sy) / np.sqrt((sxx - sx * sx) * (syy - sy * sy))
+    # Biopython goes from the largest d down and keeps the first maximum (an undefined correlation never wins)
+    pearson = np.where(np.isnan(pearson), -np.inf, pearson)[::-1]
+    best = int(np.argmax(pearson))
+    return 1 - pearson[best], int(d[::-1][best])
+
+
+def _score_tile(store, tile):
+    # the distances of the pairs i < j of one tile (row_start, row_end, col_start, col_end), from one matrix multiply
+    row_start, row_end, col_start, col_end = tile
+    rows = slice(store.offsets[row_start], store.offsets[row_end - 1] + store.lengths[row_end - 1])
+    cols = slice(store.offsets[col_start], store.offsets[col_end - 1] + store.lengths[col_end - 1])
+    products = store.values[rows] @ store.values[cols].T
+    distances = []
+    for i in range(row_start, row_end):
+        for j in range(max(i + 1, col_start), col_end):
+            a = store.offsets[i] - store.offsets[row_start]
+            b = store.offsets[j] - store.offsets[col_start]
+            table = products[a:a + store.lengths[i], b:b + store.lengths[j]]
+            distances.append((i, j, sliding_pearson(store, i, j, table)[0]))
+    return distances
+
+
+# state of a pool worker, set once by _init_worker
+_worker_state = {}
+
+
+def _init_worker(store):
+    _worker_state.update(store = store)
+
+
+def _worker_tile(tile):
+    return _score_tile(_worker_state["store"], tile)
 
 
 # The calculation of pearson distance is as follows:
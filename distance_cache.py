@@ -0,0 +1,163 @@
+# This module contains a persistent cache of motif alignments, shared by notebooks, scripts and reruns.
+# Results are keyed by motif_distance.alignment_key: a content hash of both PPMs (after pseudocounts) plus the names of
+# the column distance, alignment method, background and average, so a key never depends on motif ids or file order.
+
+import sqlite3
+from collections import OrderedDict
+
+import numpy as np
+
+from motif_distance import AlignmentResult
+
+
+class DistanceCache(object):
+    """
+    Two-level cache of motif_distance.AlignmentResult objects: a bounded in-memory LRU layer in front of an optional
+    SQLite file. It can be passed as the [cache] of motif_distance.align / distance / distance_offset and of
+    dist_from_col.calculate_distance_matrix.
+    New results are written to the file in batches; call flush() (or close(), or use the cache as a context manager)
+    to make sure everything is on disk.
+    Attributes:
+        hits/misses: number of lookups answered / not answered by the cache (memory or disk)
+        disk_hits: number of the hits that had to be read from the file
+    """
+
+    def __init__(self, path = None, capacity = 100000, batch = 1000):
+        """
+        Precondition:
+            path: None (memory only), or the path of the SQLite file, created if it does not exist
+            capacity: positive integer, the maximum number of results kept in memory
+            batch: positive integer, the number of new results collected before they are written to the file
+        """
+        assert capacity > 0 and batch > 0
+        self.capacity = capacity
+        self.batch = batch
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._memory = OrderedDict()
+        self._pending = {}
+        self._connection = None
+        if path is not None:
+            self._connection = sqlite3.connect(path)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS alignments (key TEXT PRIMARY KEY, distance REAL, offset INTEGER, "
+                "strand TEXT, aligned INTEGER, threshold REAL, profile BLOB, block TEXT)")
+
+    @property
+    def hit_rate(self):
+        """
+        Fraction of the lookups answered by the cache, 0 before the first lookup.
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        """
+        Return a dict with the lookup counts, the hit rate and the number of results held in memory.
+        """
+        return {"hits": self.hits, "misses": self.misses, "disk_hits": self.disk_hits,
+                "hit_rate": self.hit_rate, "in_memory": len(self._memory)}
+
+    def get(self, key, default = None):
+        """
+        Return the result stored under [key] (moving it to the front of the LRU layer), or [default].
+        """
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return self._memory[key]
+        result = self._read(key)
+        if result is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.disk_hits += 1
+        self._remember(key, result)
+        return result
+
+    def __getitem__(self, key):
+        result = self.get(key)
+        if result is None:
+            raise KeyError(key)
+        return result
+
+    def __contains__(self, key):
+        # membership does not count as a lookup, but a result found on disk is kept in memory for the get that follows
+        if key in self._memory:
+            return True
+        result = self._read(key)
+        if result is None:
+            return False
+        self._remember(key, result)
+        return True
+
+    def __setitem__(self, key, result):
+        self._remember(key, result)
+        if self._connection is not None:
+            self._pending[key] = result
+            if len(self._pending) >= self.batch:
+                self.flush()
+
+    def __len__(self):
+        if self._connection is None:
+            return len(self._memory)
+        self.flush()
+        return self._connection.execute("SELECT COUNT(*) FROM alignments").fetchone()[0]
+
+    def _remember(self, key, result):
+        self._memory[key] = result
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.capacity:
+            self._memory.popitem(last = False)
+
+    def _read(self, key):
+        if key in self._pending:
+            return self._pending[key]
+        if self._connection is None:
+            return None
+        row = self._connection.execute(
+            "SELECT distance, offset, strand, aligned, threshold, profile, block FROM alignments WHERE key = ?",
+            (key,)).fetchone()
+        if row is None:
+            return None
+        distance, offset, strand, aligned, threshold, profile, block = row
+        if profile is not None:
+            profile = np.frombuffer(profile, dtype = float)
+        if block is not None:
+            block = tuple(int(index) for index in block.split(","))
+        return AlignmentResult(distance, offset, strand = strand, aligned = bool(aligned), threshold = threshold,
+                               profile = profile, block = block)
+
+    def flush(self):
+        """
+        Write the results collected since the last flush to the file.
+        """
+        if self._connection is None or not self._pending:
+            return
+        rows = [(key, float(result.distance), result.offset, result.strand, int(result.aligned),
+                 None if result.threshold is None else float(result.threshold),
+                 None if result.profile is None else np.asarray(result.profile, dtype = float).tobytes(),
+                 None if result.block is None else ",".join(str(index) for index in result.block))
+                for key, result in self._pending.items()]
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO alignments VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self._pending = {}
+
+    def close(self):
+        """
+        Flush and close the file. The in-memory layer stays usable.
+        """
+        if self._connection is not None:
+            self.flush()
+            self._connection.close()
+            self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        return "DistanceCache(hits=%d, misses=%d, hit_rate=%.3f)" % (self.hits, self.misses, self.hit_rate)
@@ -0,0 +1,252 @@
+# This module contains the condensed distance matrix shared by the distance calculations and the clustering methods.
+# A symmetric matrix with a zero diagonal only needs its upper triangle, stored row by row in one numpy vector (the
+# layout of scipy.spatial.distance.squareform), instead of n * n boxed Python floats.
+# The vector can also live in a file (np.memmap), next to a JSON header with the ids and metadata, so that matrices
+# larger than the memory can be filled tile by tile, resumed after an interruption and read back lazily.
+
+import json
+import os
+
+import numpy as np
+
+
+def condensed_index(n, i, j):
+    """
+    Return the position of entry (i, j), i != j, of an n * n symmetric matrix in its condensed upper triangle.
+    i and j can also be numpy arrays of indices.
+    """
+    i, j = np.minimum(i, j), np.maximum(i, j)
+    return n * i - i * (i + 1) // 2 + (j - i - 1)
+
+
+class DistanceMatrix(object):
+    """
+    Symmetric distance matrix with a zero diagonal, stored as its condensed upper triangle.
+    It can be indexed like the nested lists it replaces: dm[i][j] (dm[i] is row i as a numpy array), and also as
+    dm[i, j] in O(1), where i and j can be index arrays (e.g. dm[np.ix_(rows, cols)] is a sub-matrix). np.asarray(dm)
+    gives the square matrix.
+    A matrix created or opened from a file only reads the entries that are indexed.
+    Attributes:
+        condensed: numpy vector of the n * (n - 1) / 2 distances above the diagonal, row by row
+        ids: list of the motif ids, in the order of the rows
+        metadata: dict describing how the distances were computed (e.g. column distance and alignment method)
+    """
+
+    def __init__(self, condensed, ids, metadata = None):
+        """
+        Precondition:
+            condensed: 1D numpy array (float64 or float32) of length len(ids) * (len(ids) - 1) / 2
+            ids: list of motif ids
+            metadata: None or a dict
+        """
+        n = len(ids)
+        assert np.ndim(condensed) == 1 and len(condensed) == n * (n - 1) // 2
+        self.condensed = condensed
+        self.ids = list(ids)
+        self.metadata = dict(metadata or {})
+
+    @classmethod
+    def zeros(cls, ids, dtype = np.float64, metadata = None):
+        """
+        Return an all-zero DistanceMatrix for [ids], to be filled through set or the condensed vector.
+        """
+        n = len(ids)
+        return cls(np.zeros(n * (n - 1) // 2, dtype = dtype), ids, metadata)
+
+    @classmethod
+    def create(cls, path, ids, dtype = np.float64, metadata = None):
+        """
+        Return an all-zero DistanceMatrix stored in the file [path] (overwritten), with its ids, dtype and metadata
+        in the JSON header path + ".json".
+        Precondition:
+            metadata: None or a dict that can be written as JSON
+        """
+        n = len(ids)
+        with open(header_path(path), "w") as header:
+            json.dump({"ids": list(ids), "dtype": np.dtype(dtype).name, "metadata": dict(metadata or {})}, header)
+        condensed = _memmap(path, np.dtype(dtype), n * (n - 1) // 2, "w+")
+        return cls(condensed, ids, metadata)
+
+    @classmethod
+    def open(cls, path, mode = "r"):
+        """
+        Return the DistanceMatrix stored in the file [path] by create, without reading its distances into memory.
+        Precondition:
+            mode: "r" (read only), "r+" (read and write) or "c" (changes stay in memory)
+        """
+        with open(header_path(path)) as header:
+            header = json.load(header)
+        n = len(header["ids"])
+        condensed = _memmap(path, np.dtype(header["dtype"]), n * (n - 1) // 2, mode)
+        return cls(condensed, header["ids"], header["metadata"])
+
+    @classmethod
+    def from_square(cls, matrix, ids, dtype = np.float64, metadata = None):
+        """
+        Build a DistanceMatrix from a square matrix (numpy array or nested lists), keeping its upper triangle.
+        """
+        matrix = np.asarray(matrix)
+        assert matrix.shape == (len(ids), len(ids))
+        return cls(matrix[np.triu_indices(len(ids), 1)].astype(dtype), ids, metadata)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index(self, i, j):
+        """
+        Return the position of entry (i, j), i != j, in the condensed vector.
+        """
+        return condensed_index(len(self.ids), i, j)
+
+    def set(self, i, j, value):
+        """
+        Set the distance between motifs i and j (i != j), on both sides of the diagonal.
+        """
+        self.condensed[self.index(i, j)] = value
+
+    def row(self, i):
+        """
+        Return row i of the square matrix as a numpy array.
+        """
+        n = len(self.ids)
+        others = np.arange(n)
+        row = np.zeros(n, dtype = self.condensed.dtype)
+        mask = others != i
+        row[mask] = self.condensed[self.index(i, others[mask])]
+        return row
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            i, j = key
+            if np.ndim(i) == 0 and np.ndim(j) == 0:
+                if i == j:
+                    return self.condensed.dtype.type(0)
+                return self.condensed[self.index(i, j)]
+            i, j = np.broadcast_arrays(np.asarray(i), np.asarray(j))
+            values = np.zeros(i.shape, dtype = self.condensed.dtype)
+            off_diagonal = i != j
+            values[off_diagonal] = self.condensed[self.index(i[off_diagonal], j[off_diagonal])]
+            return values
+        return self.row(key)
+
+    def __iter__(self):
+        for i in range(len(self.ids)):
+            yield self.row(i)
+
+    def flush(self):
+        """
+        Write the distances of a file-backed matrix to disk (nothing to do for a matrix held in memory).
+        """
+        if isinstance(self.condensed, np.memmap):
+            self.condensed.flush()
+
+    def square(self):
+        """
+        Return the full n * n matrix as a numpy array.
+        """
+        n = len(self.ids)
+        matrix = np.zeros((n, n), dtype = self.condensed.dtype)
+        upper = np.triu_indices(n, 1)
+        matrix[upper] = self.condensed
+        matrix.T[upper] = self.condensed
+        return matrix
+
+    def __array__(self, dtype = None, copy = None):
+        matrix = self.square()
+        return matrix if dtype is None else matrix.astype(dtype)
+
+    def tolist(self):
+        """
+        Return the square matrix as nested lists, the format the distance calculations used to return.
+        """
+        return self.square().tolist()
+
+    def __repr__(self):
+        return "DistanceMatrix(motifs=%d, dtype=%s, metadata=%r)" % (len(self.ids), self.condensed.dtype, self.metadata)
+
+
+class TileLedger(object):
+    """
+    Progress ledger of a distance matrix filled tile by tile: one byte per tile in the file [path], set (and flushed)
+    once the tile's distances are on disk, so that an interrupted calculation can skip the finished tiles.
+    """
+
+    def __init__(self, path, ntiles, mode = "r+"):
+        """
+        Open the ledger at [path], or create it with every tile unfinished. With mode = "w+" it is always created, so
+        that a leftover ledger (e.g. of a matrix file deleted since) can not mark the tiles of a new matrix as finished.
+        Precondition:
+            ntiles: positive integer, the number of tiles; an existing ledger opened with "r+" must have that many
+            mode: "r+" or "w+"
+        """
+        assert ntiles > 0
+        assert mode in ["r+", "w+"]
+        if mode == "r+" and os.path.exists(path):
+            assert os.path.getsize(path) == ntiles, "the ledger %s was written for another tiling" % path
+            self.done = np.memmap(path, dtype = np.uint8, mode = "r+", shape = (ntiles,))
+        else:
+            self.done = np.memmap(path, dtype = np.uint8, mode = "w+", shape = (ntiles,))
+
+    def __contains__(self, tile_index):
+        return bool(self.done[tile_index])
+
+    def mark(self, tile_index):
+        """
+        Record tile [tile_index] as finished.
+        """
+        self.done[tile_index] = 1
+        self.done.flush()
+
+    @property
+    def finished(self):
+        """
+        Number of finished tiles.
+        """
+        return int(np.count_nonzero(self.done))
+
+
+def header_path(path):
+    """
+    Return the path of the JSON header of the distance matrix file [path].
+    """
+    return path + ".json"
+
+
+def _memmap(path, dtype, size, mode):
+    # np.memmap cannot map an empty file (a matrix of fewer than two motifs), such a matrix is kept in memory
+    if size == 0:
+        if mode == "w+":
+            open(path, "wb").close()
+        return np.zeros(0, dtype = dtype)
+    return np.memmap(path, dtype = dtype, mode = mode, shape = (size,))
+
+
+class GraphDistances(object):
+    """
+    Read-only view of a sparse motif graph (a scipy.sparse matrix, e.g. from neighbour_graph.neighbour_graph) as a
+    distance matrix: absent edges are infinitely far and the diagonal is 0. Only dm[np.ix_(rows, cols)] blocks and
+    len(dm) are supported, which is what the k-means clustering uses.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph.tocsr()
+
+    def __len__(self):
+        return self.graph.shape[0]
+
+    def __getitem__(self, key):
+        rows, cols = (np.asarray(index).ravel() for index in key)
+        block = self.graph[rows][:, cols].tocoo()
+        values = np.full((len(rows), len(cols)), np.inf)
+        values[block.row, block.col] = block.data
+        values[rows[:, None] == cols[None, :]] = 0
+        return values
+
+
+def as_array(dm):
+    """
+    Return [dm] (a DistanceMatrix, a numpy array or nested lists) as a square numpy array, for the clustering methods.
+    """
+    if isinstance(dm, DistanceMatrix):
+        return dm.square()
+    return np.asarray(dm, dtype = float)
@@ -0,0 +1,75 @@
+# This module contains the dynamic programming behind the "gapped" alignment method of motif_distance.
+# It works on precomputed column distances only (the column_table of the two motifs and each column's distance to the
+# background), so it knows nothing about the column distance that produced them.
+
+import numpy as np
+
+
+def gapped_align(table, bg_dist1, bg_dist2, diagonal, gap_open = 0.5, gap_extend = 0.1, band = 3):
+    """
+    Affine-gap alignment of two motifs of lengths len1 and len2 that minimizes the summed cost of the alignment:
+      a matched column pair (i, j) costs table[i, j],
+      an unmatched column costs its distance to the background (bg_dist1[i] or bg_dist2[j]),
+      a gap inside the alignment additionally costs gap_open for its first column and gap_extend for every further one,
+      while the unmatched flanks before the first and after the last matched pair cost nothing extra (as in the
+      "expand" sliding alignment, where they face background columns).
+    Without gaps and with a single flank on each side, this is the total of the "expand" alignment at that offset.
+    Only the cells within [band] of the diagonal i - j = [diagonal] are filled (typically the best ungapped offset),
+    and the cells of each anti-diagonal i + j are filled at once, as they only depend on the two previous anti-diagonals.
+    Return (cost, pairs, start): the minimum cost, the number of matched pairs of that alignment, and the diagonal
+    i - j of its first matched pair (None if leaving every column unmatched is cheapest).
+    Preconditions:
+        table: len1 * len2 numpy matrix, table[i, j] is the distance between column i of motif 1 and column j of motif 2
+        bg_dist1/bg_dist2: numpy arrays of length len1/len2, the distance of every column to the background
+        diagonal: integer
+        gap_open/gap_extend: non-negative numbers
+        band: non-negative integer
+    """
+    len1, len2 = table.shape
+    prefix1 = np.concatenate([[0], np.cumsum(bg_dist1)])
+    prefix2 = np.concatenate([[0], np.cumsum(bg_dist2)])
+    # cost, matched pairs and diagonal of the first matched pair of the best path ending in each state at cell (i, j):
+    # 0: column i - 1 is matched to column j - 1, 1: column i - 1 is unmatched, 2: column j - 1 is unmatched
+    # (cell (i, j) has aligned the first i columns of motif 1 and the first j columns of motif 2)
+    cost = np.full((3, len1 + 1, len2 + 1), np.inf)
+    pairs = np.zeros((3, len1 + 1, len2 + 1), dtype = int)
+    start = np.zeros((3, len1 + 1, len2 + 1), dtype = int)
+    # leading flanks of either motif are free
+    cost[0, 0, 0] = 0
+    cost[1, 1:, 0] = prefix1[1:]
+    cost[2, 0, 1:] = prefix2[1:]
+    for s in range(2, len1 + len2 + 1):
+        lo = max(1, s - len2, -((band - s - diagonal) // 2))
+        hi = min(len1, s - 1, (s + diagonal + band) // 2)
+        if lo > hi:
+            continue
+        i = np.arange(lo, hi + 1)
+        j = s - i
+        # matched pair: from any state at (i - 1, j - 1)
+        best = np.argmin(cost[:, i - 1, j - 1], axis = 0)
+        pred_pairs = pairs[best, i - 1, j - 1]
+        cost[0, i, j] = cost[best, i - 1, j - 1] + table[i - 1, j - 1]
+        pairs[0, i, j] = pred_pairs + 1
+        start[0, i, j] = np.where(pred_pairs == 0, i - j, start[best, i - 1, j - 1])
+        # column i - 1 unmatched: from (i - 1, j), extending a gap in state 1 and opening one otherwise
+        _gap_step(cost, pairs, start, 1, i - 1, j, i, j, bg_dist1[i - 1], gap_open, gap_extend)
+        # column j - 1 unmatched: from (i, j - 1)
+        _gap_step(cost, pairs, start, 2, i, j - 1, i, j, bg_dist2[j - 1], gap_open, gap_extend)
+    # trailing flanks are free as well: finish after the last matched pair, or match nothing at all
+    ends = cost[0] + (prefix1[-1] - prefix1)[:, None] + (prefix2[-1] - prefix2)[None, :]
+    i, j = np.unravel_index(np.argmin(ends), ends.shape)
+    if np.isfinite(ends[i, j]) and ends[i, j] < prefix1[-1] + prefix2[-1]:
+        return ends[i, j], int(pairs[0, i, j]), int(start[0, i, j])
+    return prefix1[-1] + prefix2[-1], 0, None
+
+
+def _gap_step(cost, pairs, start, state, pi, pj, i, j, column_cost, gap_open, gap_extend):
+    # fill state 1 or 2 of cells (i, j) from cells (pi, pj): a leading flank (no pair matched yet) stays free
+    penalties = np.full((3, len(i)), gap_open)
+    penalties[state] = gap_extend
+    penalties = np.where(pairs[:, pi, pj] == 0, 0, penalties)
+    totals = cost[:, pi, pj] + penalties
+    best = np.argmin(totals, axis = 0)
+    cost[state, i, j] = totals[best, np.arange(len(i))] + column_cost
+    pairs[state, i, j] = pairs[best, pi, pj]
+    start[state, i, j] = start[best, pi, pj]
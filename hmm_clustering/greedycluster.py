@@ -42,7 +42,9 @@ def greedyclus(thresh, mtf_dict):
     curr_offset = None
     # test distance on the new matrix candidate to each existing clusters
     for (cols, ids, mtfs) in clusters.values():
-      (temp_dist, temp_offset) = mtfdis.distance_offset(coldis.Euclidean_Distance, cols, mtf_dict[curr_mtx_id].get_cols(), "expand")
+      # only distances that can still be chosen matter, so the alignment search stops as soon as it exceeds them
+      cutoff = threshold if clus == -1 else min(threshold, min_dist)
+      (temp_dist, temp_offset, _) = mtfdis.distance_bounded(coldis.Euclidean_Distance, cols, mtf_dict[curr_mtx_id].get_cols(), "expand", cutoff = cutoff)
       # attempts to find minimum distance smaller than threshold value
       if temp_dist <= threshold and (clus == -1 or temp_dist <= min_dist):
         clus = curr_clus
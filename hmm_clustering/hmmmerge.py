@@ -6,6 +6,7 @@ sys.path.insert(1, "../CS4775_MC")  # Add the parent directory to sys.path
 
 import column_distance as coldis
 import motif_distance as mtfdis
+from motif_matrix import PPMStore
 from hmm_clustering.motifdata import Mtf  
 import hmm_clustering.greedycluster as greedy
 import dataset.dbm as dbm
@@ -276,10 +277,13 @@ def offsetfix(offset, mtfs1, mtfs2):
 def hmm_fin():
     mtf_dict = {}
     curr_id = 0
-    db_instance = fg2.DNABindingMotifs().mmm
+    dataset = fg2.DNABindingMotifs()
+    db_instance = dataset.mmm
+    # the normalized columns of every motif, converted once for the whole dataset
+    ppm_store = PPMStore.of(dataset)
     # print(db_instance)
     for i in db_instance:
-        temp_mtf = Mtf(mtf=db_instance[i], id=curr_id, label = i)
+        temp_mtf = Mtf(mtf=db_instance[i], id=curr_id, label = i, cols = ppm_store[i].values)
         # pwm is a dictionary; j.pwm.get('A') gives back a very long tuple.
         my_id = temp_mtf.get_id()
         # print(temp_mtf.get_pwm())
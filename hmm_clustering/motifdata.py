@@ -11,6 +11,8 @@ import numpy as np
 
   mtf: Motif object
   id: int that stores a unique id for each value in a dataset
+  cols: None, or the normalized n*4 columns of mtf if they are already known (e.g. from a motif_matrix.PPMStore
+    built for the whole dataset), otherwise they are computed from its counts
 """
 
 
@@ -19,10 +21,13 @@ class Mtf():
   id = None
   mycols = None
   mylabel = None
-  def __init__(self, mtf, id, label):
+  def __init__(self, mtf, id, label, cols = None):
       self.mtf = mtf
       self.id = id
       self.mylabel = label
+      if cols is not None:
+        self.mycols = cols
+        return
       a = self.mtf.counts.get('A')
       t = self.mtf.counts.get('T')
       c = self.mtf.counts.get('C')
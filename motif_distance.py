@@ -2,6 +2,9 @@
 
 
 from column_distance import *
+from motif_matrix import PPM
+from gapped_alignment import gapped_align
+import hashlib
 import numpy as np
 from Bio import motifs
 from Bio.motifs import Motif
@@ -13,7 +16,7 @@ def preprocess(motif):
     """
     Return pseudocounted ppm of a motif object
     """
-    return np.array(list(motif.counts.normalize(pseudocounts=0.1).values())).T
+    return np.array(PPM.from_motif(motif, pseudocounts = 0.1))
 
 
 def naive_compare(distance_method,ppm1, ppm2, average = np.mean):
@@ -22,11 +25,20 @@ def naive_compare(distance_method,ppm1, ppm2, average = np.mean):
     to calculate the motif similarity. 
     Precondition:
         distance_method: returns a numerical distance value based on two input 4D vectors
-        ppm1, ppm2: n * 4 matrices with the same dimensionality
-        average: feed in a list, return a numerical value that represents some type of average
+        ppm1, ppm2: n * 4 matrices (or validated PPM objects) with the same dimensionality
+        average: feed in a list, return a numerical value that represents some type of average, or the name of a Reducer
     """
     assert ppm1.shape == ppm2.shape
-    col_dists = [distance_method(col1, col2) for col1, col2 in zip(ppm1, ppm2)]
+    batch = batch_kernel(distance_method)
+    if batch is not None:
+        # score all the columns in one numpy call
+        col_dists = batch(ppm1, ppm2)
+    else:
+        col_dists = [distance_method(col1, col2) for col1, col2 in zip(ppm1, ppm2)]
+    average = _average(average)
+    named = reducer(average)
+    if named is not None and named.weighted:
+        return named(col_dists, information_content(ppm1) + information_content(ppm2))
     distance = average(col_dists)
     return distance
     
@@ -50,65 +62,435 @@ def add_column(ppm, start, end, col=[0.25,0.25,0.25,0.25]):
     return np.vstack([start_m, ppm,end_m])
 
 
-def expand_compare(col_dist,ppm1,ppm2,bg=[0.25,0.25,0.25,0.25],average = np.mean):
+def bg_distances(col_dist, ppm, bg = [0.25,0.25,0.25,0.25], bg_first = False):
     """
-    Slide one motif through the other to check all possible ungapped alignments, the unmatched positions are supplied with
-    background probability.
+    Return the distance of every column of [ppm] to the background column [bg], as a 1D numpy array.
+    If [bg_first] is set, the background is passed as the first argument of [col_dist], i.e. col_dist(bg, col).
+    For a validated PPM the result is cached on the motif, once per column distance and background.
     Preconditions:
         col_dist: returns a numerical distance value based on two input 4D vectors
-        ppm1/ppm2: n * 4 numpy matrix, each row represents a position
-        bg: background frequency, represented by 4-D vectors that should sum to 1 
+        ppm: n * 4 numpy matrix, each row represents a position, or a validated PPM
+        bg: background frequency, represented by 4-D vectors that should sum to 1
+    """
+    if isinstance(ppm, PPM):
+        key = ("bg_distances", col_dist, tuple(np.asarray(bg, dtype = float).tolist()), bg_first)
+        return ppm.cached(key, lambda values: _bg_distances(col_dist, ppm, bg, bg_first))
+    return _bg_distances(col_dist, ppm, bg, bg_first)
+
+
+def _bg_distances(col_dist, ppm, bg, bg_first):
+    batch = batch_kernel(col_dist)
+    if batch is not None:
+        return batch(bg, ppm) if bg_first else batch(ppm, bg)
+    ppm = np.asarray(ppm, dtype = float)
+    bg = np.asarray(bg, dtype = float)
+    if bg_first:
+        return np.array([col_dist(bg, col) for col in ppm], dtype = float)
+    return np.array([col_dist(col, bg) for col in ppm], dtype = float)
+
+
+def bg_prefix_sums(col_dist, ppm, bg = [0.25,0.25,0.25,0.25], bg_first = False):
+    """
+    Return the prefix sums of bg_distances (starting with 0, so the last entry is the total): the summed distance to
+    the background of columns [lo, hi) is prefix[hi] - prefix[lo]. Cached on the motif for a validated PPM.
+    """
+    if isinstance(ppm, PPM):
+        key = ("bg_prefix_sums", col_dist, tuple(np.asarray(bg, dtype = float).tolist()), bg_first)
+        return ppm.cached(key, lambda values: np.concatenate([[0], np.cumsum(bg_distances(col_dist, ppm, bg, bg_first))]))
+    return np.concatenate([[0], np.cumsum(bg_distances(col_dist, ppm, bg, bg_first))])
+
+
+def no_overlap_distance(col_dist, ppm1, ppm2, bg = [0.25,0.25,0.25,0.25], average = np.mean):
+    """
+    Return the distance of the expanded alignment in which ppm1 and ppm2 do not overlap at all: every column of ppm1 faces
+    a background column and so does every column of ppm2. This is
+    naive_compare(col_dist, add_column(ppm1, 0, len(ppm2), bg), add_column(ppm2, len(ppm1), 0, bg), average = average)
+    without building the padded matrices. The value only depends on each motif's distances to the background, so with
+    np.mean and validated PPM objects it costs O(1) per pair: the summed distances are cached on the motifs.
+    Preconditions:
+        col_dist: returns a numerical distance value based on two input 4D vectors
+        ppm1/ppm2: n * 4 numpy matrix, each row represents a position, or a validated PPM
+        bg: background frequency, represented by 4-D vectors that should sum to 1
         average: feed in a list, return a numerical value that represents some type of average
     """
-    off_dist = {}
+    average = _average(average)
+    named = reducer(average)
+    if named is MEAN:
+        total1 = bg_prefix_sums(col_dist, ppm1, bg)[-1]
+        total2 = bg_prefix_sums(col_dist, ppm2, bg, bg_first = True)[-1]
+        return (total1 + total2) / (len(ppm1) + len(ppm2))
+    col_dists = np.concatenate([bg_distances(col_dist, ppm1, bg), bg_distances(col_dist, ppm2, bg, bg_first = True)])
+    if named is not None and named.weighted:
+        return named(col_dists, np.concatenate([information_content(ppm1), information_content(ppm2)]))
+    return average(col_dists)
+
+
+def information_content(ppm):
+    """
+    Return the information content of every column of [ppm] in bits, 2 - sum(-p * log2(p)), as a 1D numpy array.
+    Cached on the motif for a validated PPM.
+    """
+    if isinstance(ppm, PPM):
+        return ppm.cached("information_content", _information_content)
+    return _information_content(np.asarray(ppm, dtype = float))
+
+
+def _information_content(values):
+    plogp = values * np.log2(np.where(values > 0, values, 1))
+    return 2 + plogp.sum(axis = -1)
+
+
+class Reducer(object):
+    """
+    A named average for the [average] argument of the motif comparisons. Besides being called on a list of column
+    distances like any other average, a Reducer can score every offset of a sweep at once: [reduce] takes a
+    (number of offsets, width) matrix of column distances, padded with NaN where an offset has fewer columns, and
+    reduces it along the rows. Any other callable still works as an average, one offset at a time.
+    Attributes:
+        name: the name the reducer is registered under in REDUCERS
+        weighted: True if the average weighs every aligned position by its information content, which the caller
+            passes as a second matrix (the summed information content of the two columns, the background has none)
+    """
+    __slots__ = ("name", "weighted", "_reduce")
+
+    def __init__(self, name, reduce, weighted = False):
+        """
+        Precondition:
+            name: string
+            reduce: takes a 2D matrix of column distances padded with NaN (and the matching weights if [weighted]),
+                returns a 1D numpy array with one average per row
+            weighted: boolean
+        """
+        self.name = name
+        self.weighted = weighted
+        self._reduce = reduce
+
+    def reduce(self, matrix, weights = None):
+        if self.weighted:
+            return self._reduce(matrix, weights)
+        return self._reduce(matrix)
+
+    def __call__(self, col_dists, weights = None):
+        # without weights every position counts the same, so a weighted reducer falls back to the plain mean
+        matrix = np.asarray(col_dists, dtype = float).reshape(1, -1)
+        if self.weighted and weights is None:
+            weights = np.ones(matrix.shape)
+        elif weights is not None:
+            weights = np.asarray(weights, dtype = float).reshape(1, -1)
+        return self.reduce(matrix, weights)[0]
+
+    def __reduce__(self):
+        # the reduce functions are lambdas, so a Reducer is pickled by name
+        return (_named_reducer, (self.name,))
+
+    def __repr__(self):
+        return "Reducer(%r)" % self.name
+
+
+def _trimmed_rows(matrix, proportion):
+    # as scipy.stats.trim_mean: cut int(proportion * n) of the n values of each row from both ends
+    ordered = np.sort(matrix, axis = 1)  # NaN padding sorts last
+    counts = (~np.isnan(matrix)).sum(axis = 1)
+    cut = np.floor(proportion * counts).astype(int)
+    prefix = np.concatenate([np.zeros((len(matrix), 1)), np.cumsum(np.nan_to_num(ordered), axis = 1)], axis = 1)
+    rows = np.arange(len(matrix))
+    return (prefix[rows, counts - cut] - prefix[rows, cut]) / (counts - 2 * cut)
+
+
+def trimmed_mean(proportion = 0.1):
+    """
+    Return a Reducer for the mean after cutting the lowest and highest [proportion] of the column distances, as
+    scipy.stats.trim_mean(col_dists, proportion).
+    Precondition:
+        proportion: number in [0, 0.5)
+    """
+    assert 0 <= proportion < 0.5
+    return Reducer("trimmed_mean_%g" % proportion, lambda matrix: _trimmed_rows(matrix, proportion))
+
+
+def _weighted_rows(matrix, weights):
+    weights = np.where(np.isnan(matrix), 0, weights)
+    totals = weights.sum(axis = 1)
+    weighted = (np.nan_to_num(matrix) * weights).sum(axis = 1)
+    # positions without any information (e.g. two uniform columns) are averaged plainly
+    plain = np.nanmean(matrix, axis = 1)
+    return np.where(totals > 0, weighted / np.where(totals > 0, totals, 1), plain)
+
+
+MEAN = Reducer("mean", lambda matrix: np.nanmean(matrix, axis = 1))
+MEDIAN = Reducer("median", lambda matrix: np.nanmedian(matrix, axis = 1))
+TRIMMED_MEAN = trimmed_mean(0.1)
+IC_WEIGHTED_MEAN = Reducer("ic_weighted_mean", _weighted_rows, weighted = True)
+MAX = Reducer("max", lambda matrix: np.nanmax(matrix, axis = 1))
+
+REDUCERS = {reducer.name: reducer for reducer in [MEAN, MEDIAN, IC_WEIGHTED_MEAN, MAX]}
+REDUCERS["trimmed_mean"] = TRIMMED_MEAN
+
+# plain numpy functions that have a named reducer
+_REDUCER_ALIASES = [(np.mean, MEAN), (np.median, MEDIAN), (np.max, MAX), (max, MAX)]
+
+
+def reducer(average):
+    """
+    Return the Reducer for [average]: a Reducer itself, the name of a registered one ("mean", "median", "trimmed_mean",
+    "ic_weighted_mean", "max"), or a numpy function with the same meaning (np.mean, np.median, np.max). Return None for
+    any other callable, which is then applied to one offset at a time.
+    """
+    if isinstance(average, Reducer):
+        return average
+    if isinstance(average, str):
+        assert average in REDUCERS, "unknown average %r" % average
+        return REDUCERS[average]
+    for function, named in _REDUCER_ALIASES:
+        if average is function:
+            return named
+    return None
+
+
+def _named_reducer(name):
+    # the Reducer registered under [name], or the trimmed_mean its name describes
+    if name in REDUCERS:
+        return REDUCERS[name]
+    assert name.startswith("trimmed_mean_")
+    return trimmed_mean(float(name[len("trimmed_mean_"):]))
+
+
+def _average(average):
+    # resolve a registered name to its Reducer, leave callables alone
+    return REDUCERS[average] if isinstance(average, str) else average
+
+
+# Above this table size (len1 * len2, i.e. two motifs of about 100 columns), sweep gets the diagonal sums of the mean
+# from FFTs (column_distance.fft_diagonal_sums) instead of the column_table; below it the table is faster.
+FFT_MIN_CELLS = 100 * 100
+
+
+def sweep_offsets(len1, len2):
+    """
+    Return the offsets scored by sweep for two motifs of lengths len1 and len2, in order: the start of the shorter
+    motif relative to the start of the longer one, from -(shorter length - 1) to (longer length - 1).
+    """
+    return np.arange(-min(len1, len2) + 1, max(len1, len2))
+
+
+def sweep_matrix(col_dist, ppm1, ppm2, align_method, bg = [0.25,0.25,0.25,0.25], table = None, weights = False):
+    """
+    Return the column distances of every ungapped alignment as one (number of offsets, len1 + len2 - 1) matrix, row k
+    holding the distances at offset sweep_offsets(len(ppm1), len(ppm2))[k] (matched columns from the column_table,
+    and for "expand" the unmatched columns against [bg]), padded with NaN. The longer motif is the reference, as in
+    sweep. If [weights] is set, also return the matching matrix of summed information content of the two aligned
+    columns (the background column carries none).
+    Preconditions:
+        col_dist: returns a numerical distance value based on two input 4D vectors
+        ppm1/ppm2: n * 4 numpy matrix, each row represents a position, or a validated PPM (skips the column checks)
+        align_method: ["expand","overlap"]
+        bg: background frequency, represented by 4-D vectors that should sum to 1 (only "expand" will use it)
+        table: optional precomputed column_table(col_dist, ppm1, ppm2)
+        weights: boolean
+    """
+    assert align_method in ["expand", "overlap"]
+    if table is None:
+        table = column_table(col_dist, ppm1, ppm2)
     # swap the two matrices to ensure that ppm1 is longer than ppm2
     if len(ppm2) > len(ppm1):
         ppm2, ppm1 = ppm1, ppm2
+        table = table.T
     len1 = len(ppm1)
     len2 = len(ppm2)
-    assert len1 >= len2
-    # iterate through all possible offsets
-    for offset in range(-len(ppm2)+1,len(ppm1)):
-        if offset < 0: 
-            exp_ppm2 = add_column(ppm2, 0, len1 - offset - len2, col = bg)
-            exp_ppm1 = add_column(ppm1, -offset, 0, col = bg)
-        elif offset >= 0 and offset <= len1 - len2:
-            exp_ppm2 = add_column(ppm2, offset, len1 - len2 - offset, col = bg)
-            exp_ppm1 = ppm1
-        elif offset > len1 - len2:
-            exp_ppm2 = add_column(ppm2, offset, 0, col = bg)
-            exp_ppm1 = add_column(ppm1, 0, offset + len2 - len1, col = bg)
-        off_dist[offset] = naive_compare(col_dist, exp_ppm1, exp_ppm2, average = average)
-    return off_dist
-            
-            
-def cut_compare(col_dist, ppm1, ppm2, average = np.mean):
+    assert table.shape == (len1, len2)
+    offsets = sweep_offsets(len1, len2)[:, None]
+    # position x of the expanded alignment holds column x of ppm1 and column x - offset of ppm2
+    x = np.minimum(0, offsets) + np.arange(len1 + len2 - 1)
+    in1 = (x >= 0) & (x < len1)
+    in2 = (x - offsets >= 0) & (x - offsets < len2)
+    i1 = np.clip(x, 0, len1 - 1)
+    i2 = np.clip(x - offsets, 0, len2 - 1)
+    matrix = np.where(in1 & in2, table[i1, i2], np.nan)
+    if align_method == "expand":
+        matrix = np.where(in1 & ~in2, bg_distances(col_dist, ppm1, bg)[i1], matrix)
+        matrix = np.where(in2 & ~in1, bg_distances(col_dist, ppm2, bg, bg_first = True)[i2], matrix)
+    if not weights:
+        return matrix
+    ic = information_content(ppm1)[i1] * in1 + information_content(ppm2)[i2] * in2
+    return matrix, np.where(np.isnan(matrix), 0, ic)
+
+
+def sweep(col_dist, ppm1, ppm2, align_method, bg = [0.25,0.25,0.25,0.25], average = np.mean, table = None,
+          fft = None):
     """
-    Slide one motif through the other to check all possible ungapped alignments. Only consider the overlapping region
+    Score every ungapped alignment of ppm1 and ppm2 in one pass, and return the scores as a numpy array indexed by
+    offset: scores[k] is the distance at offset sweep_offsets(len(ppm1), len(ppm2))[k]. As in expand_compare and
+    cut_compare, the longer motif is taken as the reference and the offset is the start of the shorter one.
+    No padded copies of the motifs are built. With average = np.mean, the score of every offset comes from the
+    diagonal sums of the column_table, plus (for "expand") prefix sums of each column's distance to [bg] for the
+    unmatched positions. For column distances whose diagonal sums are a cross-correlation (Pearson_CC_Distance), the
+    table is not built at all for long motifs: the sums come from FFTs in O(L log L) (see FFT_MIN_CELLS).
+    Other averages are applied to each offset's column distances, read from the table without copying the motifs: a
+    named Reducer (see reducer) reduces the whole sweep_matrix at once, any other callable is applied to one offset at
+    a time.
     Preconditions:
         col_dist: returns a numerical distance value based on two input 4D vectors
-        ppm1/ppm2: n * 4 numpy matrix, each row represents a position
-        average: feed in a list, return a numerical value that represents some type of average
-    """    
-    off_dist = {}
+        ppm1/ppm2: n * 4 numpy matrix, each row represents a position, or a validated PPM (skips the column checks)
+        align_method: ["expand","overlap"]
+        bg: background frequency, represented by 4-D vectors that should sum to 1 (only "expand" will use it)
+        average: feed in a list, return a numerical value that represents some type of average, or the name of a Reducer
+        table: optional precomputed column_table(col_dist, ppm1, ppm2), e.g. a slice of a block_column_table
+        fft: None (FFT mode above FFT_MIN_CELLS), True or False, to force the FFT mode on or off; it only applies to
+            average = np.mean without a precomputed table and to column distances that support it
+    """
+    assert align_method in ["expand", "overlap"]
     # swap the two matrices to ensure that ppm1 is longer than ppm2
     if len(ppm2) > len(ppm1):
         ppm2, ppm1 = ppm1, ppm2
+        if table is not None:
+            table = table.T
     len1 = len(ppm1)
     len2 = len(ppm2)
-    assert len1 >= len2
-    for offset in range(-len(ppm2)+1,len(ppm1)):
-        if offset < 0: 
-            cut_ppm2 = ppm2[-offset:]
-            cut_ppm1 = ppm1[:(len2 + offset)]
-        elif offset >= 0 and offset <= len1 - len2:
-            cut_ppm2 = ppm2
-            cut_ppm1 = ppm1[offset:len2 + offset]
-        elif offset > len1 - len2:
-            cut_ppm1 = ppm1[offset:]
-            cut_ppm2 = ppm2[:len1 - offset]
-        off_dist[offset] = naive_compare(col_dist, cut_ppm1, cut_ppm2, average = average)
-    return off_dist
+    offsets = sweep_offsets(len1, len2)
+    average = _average(average)
+    named = reducer(average)
+    sums = None
+    if named is MEAN and table is None and (len1 * len2 >= FFT_MIN_CELLS if fft is None else fft):
+        sums = fft_diagonal_sums(col_dist, ppm1, ppm2)
+    if sums is None:
+        if table is None:
+            table = column_table(col_dist, ppm1, ppm2)
+        assert table.shape == (len1, len2)
+    if named is MEAN:
+        overlap = np.minimum(len1, offsets + len2) - np.maximum(0, offsets)
+        if sums is None:
+            sums = diagonal_sums(table)
+        if align_method == "overlap":
+            return sums / overlap
+        prefix1 = bg_prefix_sums(col_dist, ppm1, bg)
+        prefix2 = bg_prefix_sums(col_dist, ppm2, bg, bg_first = True)
+        # columns [lo, hi) of each motif are matched at each offset, the rest face the background
+        matched1 = prefix1[np.minimum(len1, offsets + len2)] - prefix1[np.maximum(0, offsets)]
+        matched2 = prefix2[np.minimum(len2, len1 - offsets)] - prefix2[np.maximum(0, -offsets)]
+        unmatched = (prefix1[-1] - matched1) + (prefix2[-1] - matched2)
+        return (sums + unmatched) / (len1 + len2 - overlap)
+    if named is not None:
+        # every offset at once, as one reduction along the rows of the sweep matrix
+        if named.weighted:
+            return named.reduce(*sweep_matrix(col_dist, ppm1, ppm2, align_method, bg = bg, table = table, weights = True))
+        return named.reduce(sweep_matrix(col_dist, ppm1, ppm2, align_method, bg = bg, table = table))
+    if align_method == "expand":
+        # unmatched columns of ppm1 face a background column in the expanded ppm2 and vice versa
+        dist1_bg = bg_distances(col_dist, ppm1, bg)
+        dist_bg2 = bg_distances(col_dist, ppm2, bg, bg_first = True)
+    scores = np.empty(len(offsets))
+    for k, offset in enumerate(offsets):
+        if align_method == "overlap":
+            scores[k] = average(np.diagonal(table, -offset))
+            continue
+        if offset < 0:
+            head = dist_bg2[:-offset]
+        else:
+            head = dist1_bg[:offset]
+        if offset + len2 <= len1:
+            tail = dist1_bg[offset + len2:]
+        else:
+            tail = dist_bg2[len1 - offset:]
+        scores[k] = average(np.concatenate([head, np.diagonal(table, -offset), tail]))
+    return scores
+
+
+def bounded_sweep(col_dist, ppm1, ppm2, align_method, bg = [0.25,0.25,0.25,0.25], cutoff = None, block = 4):
+    """
+    Branch-and-bound version of sweep for average = np.mean: find the best offset without scoring every offset in full.
+    The first aligned column pair of every offset is scored up front, and the offsets are visited by increasing lower
+    bound (the score they would get if all their remaining columns matched perfectly), so the diagonal with the best
+    first-column match comes first. Columns are then added [block] at a time, and an offset is abandoned as soon as its
+    partial score can no longer beat the best offset so far (column distances are never negative). Once the lower
+    bound of the next offset is too high, the search stops.
+    If [cutoff] is given, only offsets scoring <= cutoff are of interest and a pair can be rejected early as a whole.
+    Return (best score, index of the best offset in sweep_offsets(len(ppm1), len(ppm2)), number of column pairs
+    evaluated), or (np.inf, None, number of column pairs evaluated) if no offset scores <= cutoff.
+    Preconditions:
+        col_dist: returns a non-negative numerical distance value based on two input 4D vectors
+        ppm1/ppm2: n * 4 numpy matrix, each row represents a position, or a validated PPM (skips the column checks)
+        align_method: ["expand","overlap"]
+        bg: background frequency, represented by 4-D vectors that should sum to 1 (only "expand" will use it)
+        cutoff: None, or a number
+        block: positive integer, the number of columns scored at a time
+    """
+    assert align_method in ["expand", "overlap"]
+    # swap the two matrices to ensure that ppm1 is longer than ppm2
+    if len(ppm2) > len(ppm1):
+        ppm2, ppm1 = ppm1, ppm2
+    len1 = len(ppm1)
+    len2 = len(ppm2)
+    offsets = sweep_offsets(len1, len2)
+    overlap = np.minimum(len1, offsets + len2) - np.maximum(0, offsets)
+    start1 = np.maximum(0, offsets)
+    start2 = np.maximum(0, -offsets)
+    if align_method == "expand":
+        # the unmatched positions are known exactly from the prefix sums, only the matched ones are bounded
+        prefix1 = bg_prefix_sums(col_dist, ppm1, bg)
+        prefix2 = bg_prefix_sums(col_dist, ppm2, bg, bg_first = True)
+        matched1 = prefix1[start1 + overlap] - prefix1[start1]
+        matched2 = prefix2[start2 + overlap] - prefix2[start2]
+        fixed = (prefix1[-1] - matched1) + (prefix2[-1] - matched2)
+        denominator = len1 + len2 - overlap
+    else:
+        fixed = np.zeros(len(offsets))
+        denominator = overlap
+    score_pairs = pair_scorer(col_dist, ppm1, ppm2)
+    partial = fixed + score_pairs(start1, start2)
+    evaluated = len(offsets)
+    limit = np.inf if cutoff is None else cutoff
+    best_score = np.inf
+    best = None
+    for k in np.argsort(partial / denominator, kind = "stable"):
+        if partial[k] / denominator[k] > limit:
+            # the remaining offsets have even higher lower bounds
+            break
+        total = partial[k]
+        done = 1
+        while done < overlap[k] and total / denominator[k] <= limit:
+            step = min(block, overlap[k] - done)
+            total += score_pairs(slice(start1[k] + done, start1[k] + done + step),
+                                 slice(start2[k] + done, start2[k] + done + step)).sum()
+            done += step
+            evaluated += step
+        score = total / denominator[k]
+        if done == overlap[k] and score <= limit and (best is None or score < best_score or (score == best_score and k < best)):
+            best_score = score
+            best = int(k)
+            limit = min(limit, best_score)
+    return best_score, best, evaluated
+
+
+def expand_compare(col_dist,ppm1,ppm2,bg=[0.25,0.25,0.25,0.25],average = np.mean, table = None, fft = None):
+    """
+    Slide one motif through the other to check all possible ungapped alignments, the unmatched positions are supplied with
+    background probability.
+    Return a map offset -> distance, computed by sweep.
+    Preconditions:
+        col_dist: returns a numerical distance value based on two input 4D vectors
+        ppm1/ppm2: n * 4 numpy matrix, each row represents a position, or a validated PPM (skips the column checks)
+        bg: background frequency, represented by 4-D vectors that should sum to 1 
+        average: feed in a list, return a numerical value that represents some type of average
+        table: optional precomputed column_table(col_dist, ppm1, ppm2), e.g. a slice of a block_column_table
+        fft: see sweep
+    """
+    scores = sweep(col_dist, ppm1, ppm2, "expand", bg = bg, average = average, table = table, fft = fft)
+    return dict(zip(sweep_offsets(len(ppm1), len(ppm2)).tolist(), scores))
+            
+            
+def cut_compare(col_dist, ppm1, ppm2, average = np.mean, table = None, fft = None):
+    """
+    Slide one motif through the other to check all possible ungapped alignments. Only consider the overlapping region.
+    Return a map offset -> distance, computed by sweep.
+    Preconditions:
+        col_dist: returns a numerical distance value based on two input 4D vectors
+        ppm1/ppm2: n * 4 numpy matrix, each row represents a position, or a validated PPM (skips the column checks)
+        average: feed in a list, return a numerical value that represents some type of average
+        table: optional precomputed column_table(col_dist, ppm1, ppm2), e.g. a slice of a block_column_table
+        fft: see sweep
+    """    
+    scores = sweep(col_dist, ppm1, ppm2, "overlap", average = average, table = table, fft = fft)
+    return dict(zip(sweep_offsets(len(ppm1), len(ppm2)).tolist(), scores))
 
 
 def compare_align(col_dist,ppm1,ppm2, bg = [0.25,0.25,0.25,0.25]):
@@ -159,32 +541,278 @@ def compare_distance(ppm1,ppm2, bg = [0.25,0.25,0.25,0.25], average = np.mean):
     ax.set_ylabel("normalized motif distance")
     return
 
-def distance(col_dist, ppm1, ppm2, align_method, bg = [0.25,0.25,0.25,0.25], average = np.mean):
+def reverse_complement(ppm):
+    """
+    Return the matrix of the opposite strand of [ppm]: the positions reversed, with A <-> T and C <-> G swapped.
+    For a validated PPM this is the cached PPM.reverse_complement.
+    Precondition:
+        ppm: n * 4 numpy matrix in the order A, C, G, T, each row represents a position, or a validated PPM
+    """
+    if isinstance(ppm, PPM):
+        return ppm.reverse_complement()
+    return np.asarray(ppm)[::-1, ::-1]
+
+
+def strand_tables(col_dist, ppm1, ppm2):
+    """
+    Return the column tables of ppm1 against ppm2 and against the reverse complement of ppm2, i.e.
+    (column_table(col_dist, ppm1, ppm2), column_table(col_dist, ppm1, reverse_complement(ppm2))).
+    Both come from one block_column_table call, so ppm1 is prepared once and both orientations share one matrix multiply.
+    """
+    table, _, starts2 = block_column_table(col_dist, [ppm1], [ppm2, reverse_complement(ppm2)])
+    return table[:, :starts2[1]], table[:, starts2[1]:]
+
+
+class AlignmentResult(object):
+    """
+    The outcome of aligning two motifs with align.
+    Attributes:
+        distance: the motif distance, as returned by distance
+        offset: the start of the second motif relative to the first one at the best alignment (as in distance_offset),
+            None if "expand" found no meaningful alignment and fell back to the mean over all offsets
+        strand: "+" if the second motif aligns as given, "-" if its reverse complement aligns better (only with
+            both_strands)
+        aligned: True if the best alignment beat the no-overlap threshold of "expand" (always True for "overlap")
+        threshold: the no-overlap threshold of "expand", None for "overlap"
+        profile: None, or (if asked for) the numpy array of distances at every offset of the winning strand, indexed as
+            sweep_offsets(len(ppm1), len(ppm2)) with the longer motif as the reference
+        block: for "local", the aligned columns as (start1, end1, start2, end2): columns [start1, end1) of the first
+            motif face columns [start2, end2) of the second one (of its reverse complement on strand "-"), else None
+    """
+    __slots__ = ("distance", "offset", "strand", "aligned", "threshold", "profile", "block")
+
+    def __init__(self, distance, offset, strand = "+", aligned = True, threshold = None, profile = None, block = None):
+        self.distance = distance
+        self.offset = offset
+        self.strand = strand
+        self.aligned = aligned
+        self.threshold = threshold
+        self.profile = profile
+        self.block = block
+
+    def __repr__(self):
+        return "AlignmentResult(distance=%r, offset=%r, strand=%r, aligned=%r)" % (
+            float(self.distance), self.offset, self.strand, self.aligned)
+
+
+def _callable_name(function):
+    # a stable name for a column distance or an average, None if it can not identify the function (e.g. a lambda)
+    if isinstance(function, Reducer):
+        return "Reducer." + function.name
+    name = getattr(function, "__module__", None), getattr(function, "__qualname__", None)
+    if None in name or "<" in name[1]:
+        return None
+    return "%s.%s" % name
+
+
+def motif_digest(ppm):
+    """
+    Return a hex digest of the content of [ppm] (its shape and values), cached on the motif for a validated PPM.
+    """
+    if isinstance(ppm, PPM):
+        return ppm.cached("digest", _motif_digest)
+    return _motif_digest(np.asarray(ppm, dtype = float))
+
+
+def _motif_digest(values):
+    values = np.ascontiguousarray(values, dtype = float)
+    return hashlib.sha1(str(values.shape).encode() + values.tobytes()).hexdigest()
+
+
+def alignment_key(col_dist, ppm1, ppm2, align_method, bg = [0.25,0.25,0.25,0.25], average = np.mean,
+                  both_strands = False, gap_settings = (0.5, 0.1, 3), min_overlap = 4):
+    """
+    Return the cache key of align(col_dist, ppm1, ppm2, align_method, bg, average, both_strands = both_strands,
+    gap_settings = gap_settings, min_overlap = min_overlap) (gap_settings only matter to "gapped", min_overlap to
+    "local"): a string
+    built from the content of both motifs and the names of the settings, so equal motifs share a key whichever object
+    holds them. Return None if col_dist or average can not be named (e.g. a lambda), such results are not cached.
+    """
+    names = (_callable_name(col_dist), _callable_name(reducer(average) or _average(average)))
+    if None in names:
+        return None
+    bg = ",".join("%r" % value for value in np.asarray(bg, dtype = float).tolist())
+    if align_method == "gapped":
+        align_method += "(%r,%r,%r)" % tuple(gap_settings)
+    elif align_method == "local":
+        align_method += "(%r)" % min_overlap
+    return "|".join([motif_digest(ppm1), motif_digest(ppm2), names[0], align_method, bg, names[1],
+                     "both" if both_strands else "forward"])
+
+
+def align(col_dist, ppm1, ppm2, align_method, bg = [0.25,0.25,0.25,0.25], average = np.mean, table = None,
+          both_strands = False, profile = False, cache = None, gap_settings = (0.5, 0.1, 3), min_overlap = 4):
+    """
+    Align ppm1 and ppm2 once and return everything distance and distance_offset report as an AlignmentResult: the
+    distance, the offset, the strand, whether the alignment beat the threshold, and (if [profile] is set) the distances
+    at every offset.
+    If the alignment method is chosen to be "expand", the algorithm will calculate a threshold to see whether the minimum value
+    really indicates a meaningful motif alignment. If not, the result is the mean distance of all possible alignments (as all are possible).
+    "gapped" refines the best "expand" offset with gapped_alignment.gapped_align, in which unmatched columns (flanks and
+    gaps) face the background [bg] and gaps inside the alignment pay affine penalties. Its distance is the alignment's
+    cost per aligned position, its offset the diagonal of the first matched pair, and its profile the "expand" profile
+    it was guided by. It only supports average = np.mean.
+    "local" looks for the best block of at least [min_overlap] consecutive column pairs on a single diagonal (see
+    local_blocks), ignoring the columns outside of it, e.g. the flanks of an extended motif around its core. Its
+    distance is the [average] of the column distances within the block, and the block is reported.
+    Preconditions:
+        col_dist: returns a numerical distance value based on two input 4D vectors
+        ppm1/ppm2: n * 4 numpy matrix, each row represents a position, or a validated PPM (skips the column checks)
+        bg: background frequency, represented by 4-D vectors that should sum to 1 (only expand_compare will use it)
+        alignment_method: ["expand","overlap","gapped","local"]
+        average: feed in a list, return a numerical value that represents some type of average, or the name of a Reducer
+        table: optional precomputed column_table(col_dist, ppm1, ppm2), e.g. a slice of a block_column_table
+            (with both_strands, the pair of tables returned by strand_tables)
+        both_strands: if set, ppm2 is also compared on the opposite strand and the better strand is kept. Ties go to "+".
+        profile: boolean
+        cache: None, or a dict-like object mapping alignment_key to AlignmentResult, read before aligning and filled
+            after, so callers sharing it never align the same pair twice
+        gap_settings: (gap_open, gap_extend, band) of "gapped", see gapped_alignment.gapped_align
+        min_overlap: positive integer, the minimum block length of "local" (capped at the length of the shorter motif)
+    """
+    key = None
+    if cache is not None:
+        key = alignment_key(col_dist, ppm1, ppm2, align_method, bg = bg, average = average, both_strands = both_strands,
+                            gap_settings = gap_settings, min_overlap = min_overlap)
+        result = None if key is None else cache.get(key)
+        if result is not None and (result.profile is not None or not profile):
+            return result
+    if both_strands:
+        # one table call covers both orientations of ppm2
+        forward, reverse = strand_tables(col_dist, ppm1, ppm2) if table is None else table
+        result = _align(col_dist, ppm1, ppm2, align_method, bg, average, forward, profile, gap_settings, min_overlap)
+        reverse_result = _align(col_dist, ppm1, reverse_complement(ppm2), align_method, bg, average, reverse, profile,
+                                gap_settings, min_overlap)
+        if reverse_result.distance < result.distance:
+            result = reverse_result
+            result.strand = "-"
+    else:
+        result = _align(col_dist, ppm1, ppm2, align_method, bg, average, table, profile, gap_settings, min_overlap)
+    if key is not None:
+        cache[key] = result
+    return result
+
+
+def _align(col_dist, ppm1, ppm2, align_method, bg, average, table, profile, gap_settings, min_overlap):
+    if align_method == "gapped":
+        return _align_gapped(col_dist, ppm1, ppm2, bg, average, table, profile, gap_settings)
+    if align_method == "local":
+        return _align_local(col_dist, ppm1, ppm2, bg, average, table, profile, min_overlap)
+    # if swapped, the offset should reverse the sign to indicate that the first motif is taken as relative. 
+    swap = 1
+    if len(ppm2) > len(ppm1):
+        swap = -1
+    # as with expand_compare's default, the sweep pads with the uniform background; bg enters the threshold
+    scores = sweep(col_dist, ppm1, ppm2, align_method, average = average, table = table)
+    best = int(np.argmin(scores))
+    offset = int(sweep_offsets(len(ppm1), len(ppm2))[best]) * swap
+    profile = scores if profile else None
+    if align_method == "overlap":
+        return AlignmentResult(scores[best], offset, profile = profile)
+    # The threshold is calculated as the distance when the motifs are not overlapping with each other. 
+    threshold = no_overlap_distance(col_dist, ppm1, ppm2, bg = bg, average = average)
+    if scores[best] < threshold:
+        # This might be a meaningful alignment
+        return AlignmentResult(scores[best], offset, threshold = threshold, profile = profile)
+    # just return the mean distance of all possible alignments
+    return AlignmentResult(np.mean(scores), None, aligned = False, threshold = threshold, profile = profile)
+
+
+def _align_gapped(col_dist, ppm1, ppm2, bg, average, table, profile, gap_settings):
+    assert reducer(average) is MEAN, "gapped alignment scores the mean cost per aligned position"
+    gap_open, gap_extend, band = gap_settings
+    if table is None:
+        table = column_table(col_dist, ppm1, ppm2)
+    # the band follows the best ungapped diagonal
+    scores = sweep(col_dist, ppm1, ppm2, "expand", bg = bg, table = table)
+    diagonal = int(sweep_offsets(len(ppm1), len(ppm2))[int(np.argmin(scores))])
+    if len(ppm2) > len(ppm1):
+        diagonal = -diagonal
+    cost, pairs, start = gapped_align(table, bg_distances(col_dist, ppm1, bg), bg_distances(col_dist, ppm2, bg,
+                                      bg_first = True), diagonal, gap_open = gap_open, gap_extend = gap_extend,
+                                      band = band)
+    return AlignmentResult(cost / (len(ppm1) + len(ppm2) - pairs), start, aligned = pairs > 0,
+                           profile = scores if profile else None)
+
+
+def local_blocks(table, bg_dist1, bg_dist2, min_overlap = 4):
+    """
+    Find the best block of consecutive column pairs on one diagonal of a column table: the block of at least
+    [min_overlap] pairs with the largest total gain, where pair (i, j) gains (bg_dist1[i] + bg_dist2[j]) / 2 - table[i, j],
+    i.e. how much closer the two columns are to each other than (on average) to the background. Uninformative columns
+    gain nothing from being matched, so the block does not stretch over flanks close to the background.
+    All diagonals are scored at once by maximum-subarray scoring on the prefix sums of their gains.
+    Return (start1, end1, start2, end2, gain): the block covers rows [start1, end1) and columns [start2, end2).
+    Preconditions:
+        table: len1 * len2 numpy matrix of column distances
+        bg_dist1/bg_dist2: numpy arrays of length len1/len2, the distance of every column to the background
+        min_overlap: positive integer, capped at min(len1, len2)
+    """
+    len1, len2 = table.shape
+    min_overlap = min(min_overlap, len1, len2)
+    # diagonal k holds the pairs (start1[k] + t, start2[k] + t) for t < lengths[k]
+    diagonals = np.arange(-(len2 - 1), len1)
+    start1 = np.maximum(0, diagonals)
+    start2 = np.maximum(0, -diagonals)
+    lengths = np.minimum(len1 - start1, len2 - start2)
+    t = np.arange(min(len1, len2))
+    inside = t < lengths[:, None]
+    rows = np.minimum(start1[:, None] + t, len1 - 1)
+    cols = np.minimum(start2[:, None] + t, len2 - 1)
+    gains = np.where(inside, (bg_dist1[rows] + bg_dist2[cols]) / 2 - table[rows, cols], 0)
+    prefix = np.concatenate([np.zeros((len(diagonals), 1)), np.cumsum(gains, axis = 1)], axis = 1)
+    # the best block ending at e starts at the smallest prefix sum at or before e - min_overlap
+    lowest = np.minimum.accumulate(prefix, axis = 1)
+    ends = np.arange(min_overlap, prefix.shape[1])
+    totals = np.where(ends <= lengths[:, None], prefix[:, ends] - lowest[:, ends - min_overlap], -np.inf)
+    k, e = np.unravel_index(np.argmax(totals), totals.shape)
+    end = ends[e]
+    begin = int(np.argmin(prefix[k, :end - min_overlap + 1]))
+    return (int(start1[k] + begin), int(start1[k] + end), int(start2[k] + begin), int(start2[k] + end),
+            totals[k, e])
+
+
+def _align_local(col_dist, ppm1, ppm2, bg, average, table, profile, min_overlap):
+    if table is None:
+        table = column_table(col_dist, ppm1, ppm2)
+    start1, end1, start2, end2, gain = local_blocks(table, bg_distances(col_dist, ppm1, bg),
+                                                    bg_distances(col_dist, ppm2, bg, bg_first = True), min_overlap)
+    block_dists = table[np.arange(start1, end1), np.arange(start2, end2)]
+    named = reducer(average)
+    if named is not None and named.weighted:
+        value = named(block_dists, information_content(ppm1)[start1:end1] + information_content(ppm2)[start2:end2])
+    else:
+        value = _average(average)(block_dists)
+    scores = sweep(col_dist, ppm1, ppm2, "overlap", average = average, table = table) if profile else None
+    return AlignmentResult(value, start1 - start2, aligned = bool(gain > 0), profile = scores,
+                           block = (start1, end1, start2, end2))
+
+
+def distance(col_dist, ppm1, ppm2, align_method, bg = [0.25,0.25,0.25,0.25], average = np.mean, table = None,
+             both_strands = False, cache = None, gap_settings = (0.5, 0.1, 3), min_overlap = 4):
     """
     Return the shortest alignment distance between ppm1, ppm2, calculated via column-wise distance measurement [col_dist] with [align_method]. 
     If the alignment method is chosen to be "expand", the algorithm will calculate a threshold to see whether the minimum value
     really indicates a meaningful motif alignment. If not, the algorithm will return the mean distance of all possible alignments (as all are possible). 
+    This is align(...).distance.
     Preconditions:
         col_dist: returns a numerical distance value based on two input 4D vectors
-        ppm1/ppm2: n * 4 numpy matrix, each row represents a position
+        ppm1/ppm2: n * 4 numpy matrix, each row represents a position, or a validated PPM (skips the column checks)
         bg: background frequency, represented by 4-D vectors that should sum to 1 (only expand_compare will use it)
-        alignment_method: ["expand","overlap"]
+        alignment_method: ["expand","overlap","gapped","local"]
+        table: optional precomputed column_table(col_dist, ppm1, ppm2), e.g. a slice of a block_column_table
+            (with both_strands, the pair of tables returned by strand_tables)
+        both_strands: if set, ppm2 is also compared on the opposite strand and the smaller distance is returned
+        cache: None, or a dict-like cache of AlignmentResult shared with other align calls
+        gap_settings: (gap_open, gap_extend, band) of "gapped", see align
+        min_overlap: the minimum block length of "local", see align
     """
-    if align_method == "expand":
-        output = list(expand_compare(col_dist, ppm1,ppm2, average = average).values())
-        minimum =  min(output)
-        # The threshold is calculated as the distance when the motifs are not overlapping with each other. 
-        threshold = naive_compare(col_dist, add_column(ppm1,0, len(ppm2),bg), add_column(ppm2,len(ppm1),0,bg), average = average)
-        if minimum < threshold:
-            # This might be a meaningful alignment
-            return minimum
-        else:
-            # just return the mean distance of all possible alignments
-            return np.mean(output)
-    elif align_method == "overlap":
-        return min(list(cut_compare(col_dist, ppm1, ppm2, average = average).values()))
+    return align(col_dist, ppm1, ppm2, align_method, bg = bg, average = average, table = table,
+                 both_strands = both_strands, cache = cache, gap_settings = gap_settings,
+                 min_overlap = min_overlap).distance
 
-def distance_offset(col_dist, ppm1, ppm2, align_method, bg = [0.25,0.25,0.25,0.25], average = np.mean):
+def distance_offset(col_dist, ppm1, ppm2, align_method, bg = [0.25,0.25,0.25,0.25], average = np.mean, table = None,
+                    both_strands = False, cache = None, gap_settings = (0.5, 0.1, 3), min_overlap = 4):
     """
     Return the shortest alignment distance between ppm1, ppm2 as well as the offset of the two motifs for calculating this distance,
       calculated via column-wise distance measurement [col_dist] with [align_method]. The offset indicates how many positions the second 
@@ -192,27 +820,214 @@ def distance_offset(col_dist, ppm1, ppm2, align_method, bg = [0.25,0.25,0.25,0.2
       [0, len(motif1)) and [offset, len(motif2) + offset). If the offset is None, it indicates that there is no meaningful alignment. 
     If the alignment method is chosen to be "expand", the algorithm will calculate a threshold to see whether the minimum value
     really indicates a meaningful motif alignment. If not, the algorithm will return the mean distance of all possible alignments (as all are possible). 
+    The offset is only reported for "expand", "gapped" and "local" (align keeps the best offset of "overlap" as well).
     Preconditions:
         col_dist: returns a numerical distance value based on two input 4D vectors
-        ppm1/ppm2: n * 4 numpy matrix, each row represents a position
+        ppm1/ppm2: n * 4 numpy matrix, each row represents a position, or a validated PPM (skips the column checks)
+        bg: background frequency, represented by 4-D vectors that should sum to 1 (only expand_compare will use it)
+        alignment_method: ["expand","overlap","gapped","local"]
+        table: optional precomputed column_table(col_dist, ppm1, ppm2), e.g. a slice of a block_column_table
+            (with both_strands, the pair of tables returned by strand_tables)
+        both_strands: if set, ppm2 is also compared on the opposite strand, and the result becomes
+            (distance, offset, strand): strand is "+" if ppm2 aligns as given and "-" if its reverse complement aligns
+            better (the offset is then the start of reverse_complement(ppm2)). Ties go to "+".
+        cache: None, or a dict-like cache of AlignmentResult shared with other align calls
+        gap_settings: (gap_open, gap_extend, band) of "gapped", see align
+        min_overlap: the minimum block length of "local", see align
+    """
+    result = align(col_dist, ppm1, ppm2, align_method, bg = bg, average = average, table = table,
+                   both_strands = both_strands, cache = cache, gap_settings = gap_settings,
+                   min_overlap = min_overlap)
+    offset = result.offset if align_method != "overlap" else None
+    if both_strands:
+        return result.distance, offset, result.strand
+    return result.distance, offset
+
+
+def align_library(col_dist, query, library, align_method, bg = [0.25,0.25,0.25,0.25], average = np.mean):
+    """
+    Align one query motif against every motif of a PPMLibrary, as align(col_dist, query, library[n], align_method, bg,
+    average) for every n, and return (distances, offsets, aligned) as numpy arrays of length len(library).
+    offsets[n] is the start of library[n] relative to the query at its best alignment (the offset of distance_offset,
+    also kept for "overlap"), and is only meaningful where aligned[n] is True, i.e. where the best alignment of "expand"
+    beat the no-overlap threshold (otherwise distances[n] is the mean over all offsets, as in distance).
+    The whole library is scored by array operations on one column_table call between the query and the library's
+    padded columns, masked by the motif lengths: with np.mean through the sums along every diagonal of every target,
+    with any other named Reducer by reducing the sweep matrices of all targets at once. Other averages align the
+    targets one by one.
+    Preconditions:
+        col_dist: returns a numerical distance value based on two input 4D vectors
+        query: n * 4 numpy matrix, each row represents a position, or a validated PPM
+        library: PPMLibrary
+        align_method: ["expand","overlap"]
+        bg: background frequency, represented by 4-D vectors that should sum to 1 (only expand_compare will use it)
+        average: feed in a list, return a numerical value that represents some type of average, or the name of a Reducer
+    """
+    assert align_method in ["expand", "overlap"]
+    named = reducer(average)
+    if named is None:
+        results = [align(col_dist, query, ppm, align_method, bg = bg, average = average) for ppm in library]
+        return (np.array([result.distance for result in results], dtype = float),
+                np.array([0 if result.offset is None else result.offset for result in results]),
+                np.array([result.aligned for result in results]))
+    len_q = len(query)
+    lengths = library.lengths
+    count, max_length = library.mask.shape
+    targets = np.arange(count)
+    # table[i, n, j]: distance between column i of the query and column j of target n
+    table = column_table(col_dist, query, library.columns).reshape(len_q, count, max_length)
+    # offset o puts column j of the target under column i = j + o of the query
+    offsets = np.arange(-(max_length - 1), len_q)
+    overlap = np.clip(np.minimum(len_q, offsets[:, None] + lengths) - np.maximum(0, offsets)[:, None], 0, None)
+    valid = overlap > 0
+    # as in distance, the sweep pads with the uniform background, and the longer motif's columns are the first
+    # argument of col_dist against the background
+    query_longer = len_q >= lengths
+    if named is MEAN:
+        scores = _library_mean_scores(col_dist, query, library, align_method, table, offsets, overlap, query_longer)
+    else:
+        matrix, weights = _library_sweep_matrix(col_dist, query, library, align_method, table, offsets, query_longer,
+                                                named.weighted)
+        # offsets beyond a short target have no columns in "overlap", only the others are reduced
+        rows = valid.ravel()
+        scores = np.full(rows.shape, np.inf)
+        scores[rows] = named.reduce(matrix[rows], None if weights is None else weights[rows])
+        scores = scores.reshape(valid.shape)
+    scores = np.where(valid, scores, np.inf)
+    # sweep orders the offsets from the longer motif, so a longer target visits them in reverse (ties go to the first)
+    ascending = np.argmin(scores, axis = 0)
+    descending = len(offsets) - 1 - np.argmin(scores[::-1], axis = 0)
+    best = np.where(lengths > len_q, descending, ascending)
+    distances = scores[best, targets]
+    best_offsets = offsets[best]
+    if align_method == "overlap":
+        return distances, best_offsets, np.ones(count, dtype = bool)
+    # The threshold is calculated as the distance when the motifs are not overlapping with each other.
+    if named is MEAN:
+        totals = np.where(library.mask, _library_bg_distances(col_dist, library, np.zeros(count, dtype = bool), bg),
+                          0).sum(axis = 1)
+        threshold = (bg_prefix_sums(col_dist, query, bg)[-1] + totals) / (len_q + lengths)
+    else:
+        to_bg = np.broadcast_to(bg_distances(col_dist, query, bg), (count, len_q))
+        from_bg = np.where(library.mask, _library_bg_distances(col_dist, library, np.zeros(count, dtype = bool), bg),
+                           np.nan)
+        weights = None
+        if named.weighted:
+            weights = np.concatenate([np.broadcast_to(information_content(query), (count, len_q)),
+                                      information_content(library.columns).reshape(count, max_length)], axis = 1)
+        threshold = named.reduce(np.concatenate([to_bg, from_bg], axis = 1), weights)
+    aligned = distances < threshold
+    # just return the mean distance of all possible alignments
+    means = np.where(valid, scores, 0).sum(axis = 0) / valid.sum(axis = 0)
+    return np.where(aligned, distances, means), best_offsets, aligned
+
+
+def _library_bg_distances(col_dist, library, first, bg = [0.25,0.25,0.25,0.25]):
+    # (N, Lmax) distances of every target column to the background, with the target as the first argument of col_dist
+    # where [first] is set and as the second one elsewhere (padding positions included)
+    count, max_length = library.mask.shape
+    to_bg = bg_distances(col_dist, library.columns, bg).reshape(count, max_length)
+    from_bg = bg_distances(col_dist, library.columns, bg, bg_first = True).reshape(count, max_length)
+    return np.where(first[:, None], to_bg, from_bg)
+
+
+def _query_bg_distances(col_dist, query, query_longer):
+    # (len(query), N) distances of the query columns to the uniform background, ordered as for _library_bg_distances
+    return np.where(query_longer, bg_distances(col_dist, query)[:, None],
+                    bg_distances(col_dist, query, bg_first = True)[:, None])
+
+
+def _library_mean_scores(col_dist, query, library, align_method, table, offsets, overlap, query_longer):
+    # (offsets, N) mean distances from the diagonal sums of every target, plus prefix sums for the unmatched columns
+    len_q = len(query)
+    lengths = library.lengths
+    count, max_length = library.mask.shape
+    targets = np.arange(count)
+    rows = np.arange(len_q)
+    j = rows - offsets[:, None]
+    matched = (j[:, :, None] >= 0) & (j[:, :, None] < lengths)
+    sums = np.where(matched, table[rows, :, np.clip(j, 0, max_length - 1)], 0).sum(axis = 1)
+    if align_method == "overlap":
+        return sums / np.maximum(overlap, 1)
+    prefix_q = np.concatenate([np.zeros((1, count)), np.cumsum(_query_bg_distances(col_dist, query, query_longer),
+                                                               axis = 0)])
+    target_bg = np.where(library.mask, _library_bg_distances(col_dist, library, ~query_longer), 0)
+    prefix_t = np.concatenate([np.zeros((count, 1)), np.cumsum(target_bg, axis = 1)], axis = 1)
+    matched_q = (prefix_q[np.clip(offsets[:, None] + lengths, 0, len_q), targets]
+                 - prefix_q[np.clip(offsets, 0, len_q)[:, None], targets])
+    matched_t = (prefix_t[targets, np.clip(len_q - offsets[:, None], 0, lengths)]
+                 - prefix_t[targets, np.clip(-offsets[:, None], 0, lengths)])
+    unmatched = (prefix_q[-1] - matched_q) + (prefix_t[targets, lengths] - matched_t)
+    return (sums + unmatched) / (len_q + lengths - overlap)
+
+
+def _library_sweep_matrix(col_dist, query, library, align_method, table, offsets, query_longer, weights):
+    # the sweep_matrix of every target, as one (offsets * N, len(query) + Lmax - 1) matrix padded with NaN (row
+    # k * N + n holds offset k of target n), and the matching information content weights if [weights] is set
+    len_q = len(query)
+    lengths = library.lengths
+    count, max_length = library.mask.shape
+    targets = np.arange(count)
+    # position x of the expanded alignment holds column x of the query and column x - offset of the target
+    x = (np.minimum(0, offsets)[:, None] + np.arange(len_q + max_length - 1))[:, None, :]
+    j = x - offsets[:, None, None]
+    in_q = (x >= 0) & (x < len_q)
+    in_t = (j >= 0) & (j < lengths[:, None])
+    i_q = np.clip(x, 0, len_q - 1)
+    i_t = np.clip(j, 0, max_length - 1)
+    matrix = np.where(in_q & in_t, table[i_q, targets[:, None], i_t], np.nan)
+    if align_method == "expand":
+        query_bg = _query_bg_distances(col_dist, query, query_longer)
+        target_bg = _library_bg_distances(col_dist, library, ~query_longer)
+        matrix = np.where(in_q & ~in_t, query_bg[i_q, targets[:, None]], matrix)
+        matrix = np.where(in_t & ~in_q, target_bg[targets[:, None], i_t], matrix)
+    matrix = matrix.reshape(-1, matrix.shape[-1])
+    if not weights:
+        return matrix, None
+    ic_t = information_content(library.columns).reshape(count, max_length)
+    ic = information_content(query)[i_q] * in_q + ic_t[targets[:, None], i_t] * in_t
+    return matrix, np.where(np.isnan(matrix), 0, ic.reshape(matrix.shape))
+
+
+def distance_bounded(col_dist, ppm1, ppm2, align_method, bg = [0.25,0.25,0.25,0.25], cutoff = None, block = 4):
+    """
+    Early-abandoning version of distance_offset with average = np.mean, built on bounded_sweep. It returns the same
+    distance, but skips the column pairs that can not change the result, and reports how many were evaluated.
+    If [cutoff] is given (e.g. the join threshold of greedy clustering), a pair whose distance is larger than cutoff is
+    rejected as soon as that is certain, and reported with distance np.inf. The exception is the "expand" fallback: if
+    no offset beats no_overlap_distance and cutoff is not below it, the distance is the mean over all offsets, which is
+    computed in full and returned exactly even when it is above cutoff.
+    Return (distance, offset, number of column pairs evaluated). The offset follows distance_offset: it is the start of
+    ppm2 relative to ppm1, and None if there is no meaningful alignment ("expand" falls back to the mean over all
+    offsets), but it is also reported for "overlap".
+    Preconditions:
+        col_dist: returns a non-negative numerical distance value based on two input 4D vectors
+        ppm1/ppm2: n * 4 numpy matrix, each row represents a position, or a validated PPM (skips the column checks)
         bg: background frequency, represented by 4-D vectors that should sum to 1 (only expand_compare will use it)
         alignment_method: ["expand","overlap"]
+        cutoff: None, or a number
+        block: positive integer, the number of columns scored at a time
     """
     # if swapped, the offset should reverse the sign to indicate that the first motif is taken as relative. 
     swap = 1
     if len(ppm2) > len(ppm1):
         swap = -1
+    # as in distance, the sweep pads with the uniform background; bg enters the threshold
+    threshold = None
+    search_cutoff = cutoff
     if align_method == "expand":
-        # The threshold is calculated as the distance when the motifs are not overlapping with each other. 
-        threshold = naive_compare(col_dist, add_column(ppm1,0, len(ppm2),bg), add_column(ppm2,len(ppm1),0,bg), average = average)
-        output = expand_compare(col_dist, ppm1,ppm2, average = average)
-        min_key = min(output, key=output.get)
-        min_value = output[min_key]
-        if min_value < threshold:
-            # This might be a meaningful alignment
-            return min_value, int(min_key) * swap
-        else:
-            # just return the mean distance of all possible alignments
-            return np.mean(list(output.values())), None
-    elif align_method == "overlap":
-        return min(list(cut_compare(col_dist, ppm1, ppm2, average = average).values())), None
\ No newline at end of file
+        # only an offset below the threshold is kept as an alignment, so the search can abandon offsets there too
+        threshold = no_overlap_distance(col_dist, ppm1, ppm2, bg = bg)
+        search_cutoff = threshold if cutoff is None else min(cutoff, threshold)
+    best_score, best, evaluated = bounded_sweep(col_dist, ppm1, ppm2, align_method, cutoff = search_cutoff,
+                                                block = block)
+    if best is not None and (threshold is None or best_score < threshold):
+        # This might be a meaningful alignment
+        offset = int(sweep_offsets(len(ppm1), len(ppm2))[best]) * swap
+        return best_score, offset, evaluated
+    if cutoff is not None and (threshold is None or cutoff < threshold):
+        # every offset, and so also the mean over all of them, is above the cutoff
+        return np.inf, None, evaluated
+    # just return the mean distance of all possible alignments, which needs every offset in full
+    scores = sweep(col_dist, ppm1, ppm2, align_method)
+    return np.mean(scores), None, evaluated + len(ppm1) * len(ppm2)
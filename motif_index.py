@@ -0,0 +1,160 @@
+# This module contains an approximate nearest-neighbour index of motifs, to propose candidate neighbours cheaply.
+# Every PPM is embedded as a fixed-length vector (its k-mer affinity profile), the vectors are hashed with random
+# hyperplanes (locality sensitive hashing for the cosine distance), and only the motifs sharing a bucket with a motif
+# are ranked as its candidates. The exact alignments then only run on the top candidates of every motif
+# (neighbour_graph.neighbour_graph with candidates), and recall_at_k reports what was lost against the exact matrix.
+
+import numpy as np
+
+from motif_matrix import PPMStore
+
+
+def kmer_profile(ppm, k = 4, both_strands = True):
+    """
+    Return the k-mer affinity profile of [ppm] as a unit vector of length 4 ** k (k-mers in lexicographic A, C, G, T
+    order): the expected number of occurrences of every k-mer in a sequence drawn from the motif, summed over its
+    windows of k positions. A motif shorter than k has a zero profile.
+    If [both_strands] is set, the profile of the reverse complement is added, so that the profile of a motif and of its
+    reverse complement are the same.
+    Precondition:
+        ppm: n * 4 numpy matrix, each row represents a position, or a validated PPM
+        k: positive integer
+    """
+    values = np.asarray(ppm, dtype = float)
+    windows = len(values) - k + 1
+    if windows <= 0:
+        return np.zeros(4 ** k)
+    # probabilities[s, w]: probability of k-mer w at window s, extended one position at a time
+    probabilities = values[:windows]
+    for t in range(1, k):
+        probabilities = (probabilities[:, :, None] * values[t:t + windows, None, :]).reshape(windows, -1)
+    profile = probabilities.sum(axis = 0)
+    if both_strands:
+        # the reverse complement holds k-mer w where the motif holds its reverse complement
+        profile = profile + profile[_reverse_complement_kmers(k)]
+    norm = np.sqrt(np.sum(profile * profile))
+    return profile / norm if norm > 0 else profile
+
+
+def _reverse_complement_kmers(k):
+    # index of the reverse complement of every k-mer: digits (A=0, C=1, G=2, T=3) complemented and reversed
+    digits = np.indices((4,) * k).reshape(k, -1)
+    return np.tensordot(4 ** np.arange(k), 3 - digits, axes = 1)
+
+
+class MotifIndex(object):
+    """
+    Random-projection LSH index of the k-mer profiles of a motif set.
+    Each of [tables] hash tables cuts the profiles with [bits] random hyperplanes through their mean (the profiles
+    are all positive, so planes through the origin would hardly split them), and puts the motifs on the same side of
+    all of them in one bucket. Two motifs share a bucket of a table with probability
+    (1 - angle / pi) ** bits, so more tables raise the recall and more bits make the buckets (and the candidate lists to
+    rank) smaller.
+    Attributes:
+        embeddings: N * 4 ** k numpy array, the profile of every motif
+        center: the mean profile, the origin of the hyperplanes
+        codes: N * tables int numpy array, the bucket of every motif in every table
+        buckets: list of one dict per table, bucket -> int numpy array of its motifs
+    """
+
+    def __init__(self, ppms, k = 4, tables = 8, bits = 8, both_strands = True, seed = 0):
+        """
+        Precondition:
+            ppms: non-empty list of n * 4 numpy matrices or validated PPM objects
+            k: positive integer, the k-mer length of the profiles
+            tables/bits: positive integers
+            seed: seed of the random hyperplanes
+        """
+        assert len(ppms) > 0 and tables > 0 and bits > 0
+        self.k = k
+        self.both_strands = both_strands
+        self.embeddings = np.array([kmer_profile(ppm, k, both_strands) for ppm in ppms])
+        self.center = self.embeddings.mean(axis = 0)
+        self._planes = np.random.default_rng(seed).standard_normal((tables, bits, 4 ** k))
+        self.codes = self._hash(self.embeddings)
+        self.buckets = []
+        for table in range(tables):
+            order = np.argsort(self.codes[:, table], kind = "stable")
+            codes, starts = np.unique(self.codes[order, table], return_index = True)
+            self.buckets.append(dict(zip(codes.tolist(), np.split(order, starts[1:]))))
+
+    @classmethod
+    def from_dataset(cls, dataset, **settings):
+        """
+        Build the index of the motifs of [dataset] in the order of its PPMStore (the order of dist_from_col and
+        neighbour_graph), pseudocounted with 0.5 as there.
+        """
+        return cls(PPMStore.of(dataset, pseudocounts = 0.5).ppms, **settings)
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def _hash(self, embeddings):
+        # bit b of the code of table t is set if the embedding is on the positive side of hyperplane b of table t
+        sides = np.tensordot(embeddings - self.center, self._planes, axes = ([1], [2])) > 0
+        return np.tensordot(sides, 2 ** np.arange(self._planes.shape[1]), axes = 1)
+
+    def query(self, ppm, m = 10):
+        """
+        Return the indices of at most [m] candidate neighbours of [ppm] (any motif, indexed or not): the motifs sharing a
+        bucket with it in some table, closest profiles first.
+        Precondition:
+            m: positive integer
+        """
+        embedding = kmer_profile(ppm, self.k, self.both_strands)
+        return self._rank(embedding, self._hash(embedding[None, :])[0], m, exclude = None)
+
+    def candidates(self, n, m = 10):
+        """
+        Return the indices of at most [m] candidate neighbours of indexed motif [n], closest profiles first.
+        """
+        return self._rank(self.embeddings[n], self.codes[n], m, exclude = n)
+
+    def all_candidates(self, m = 10):
+        """
+        Return the candidates of every indexed motif, as a list of index arrays (see candidates).
+        """
+        return [self.candidates(n, m) for n in range(len(self))]
+
+    def _rank(self, embedding, codes, m, exclude):
+        members = [self.buckets[table].get(code) for table, code in enumerate(codes.tolist())]
+        members = [bucket for bucket in members if bucket is not None]
+        if not members:
+            return np.zeros(0, dtype = int)
+        found = np.unique(np.concatenate(members))
+        if exclude is not None:
+            found = found[found != exclude]
+        # cosine distance of unit vectors, ties in index order
+        order = np.argsort(-(self.embeddings[found] @ embedding), kind = "stable")
+        return found[order[:m]]
+
+
+def candidate_pairs(candidates):
+    """
+    Return the sorted list of the distinct pairs (i, j), i < j, proposed by [candidates] (one iterable of candidate
+    indices per motif, e.g. MotifIndex.all_candidates): the pairs an approximate graph has to align.
+    """
+    return sorted({(min(i, int(j)), max(i, int(j))) for i, proposed in enumerate(candidates) for j in proposed
+                   if int(j) != i})
+
+
+def recall_at_k(graph, distance_matrix, k):
+    """
+    Return the mean fraction of the exact [k] nearest neighbours of every motif (from [distance_matrix]) that are
+    among its [k] nearest neighbours in the sparse [graph], e.g. an approximate neighbour_graph over the same motifs.
+    Precondition:
+        graph: scipy.sparse matrix of distances, in the motif order of [distance_matrix]
+        distance_matrix: distance_matrix.DistanceMatrix, numpy array or nested lists
+        k: positive integer, smaller than the number of motifs
+    """
+    graph = graph.tocsr()
+    recalls = []
+    for i in range(graph.shape[0]):
+        row = np.asarray(distance_matrix[i], dtype = float).copy()
+        row[i] = np.inf
+        exact = set(np.argsort(row, kind = "stable")[:k].tolist())
+        edges = slice(graph.indptr[i], graph.indptr[i + 1])
+        neighbours, distances = graph.indices[edges], graph.data[edges]
+        found = set(neighbours[np.argsort(distances, kind = "stable")[:k]].tolist())
+        recalls.append(len(exact & found) / k)
+    return float(np.mean(recalls))
@@ -0,0 +1,272 @@
+# This module contains the PPM container: a validated, read-only position probability matrix.
+# The column distances in column_distance (and the motif comparisons in motif_distance) accept PPM objects
+# and trust their invariants, so the preconditions are only checked once per motif instead of once per column pair.
+
+import numpy as np
+
+
+class PPM(object):
+    """
+    Validated, immutable position probability matrix.
+    The matrix is pseudocounted, normalized and checked once when the object is built.
+    Attributes:
+        values: read-only n * 4 numpy matrix, each row represents a position (A, C, G, T) and sums up to 1
+        pseudocounts: the pseudocounts added to the raw matrix before normalization
+        nonzero: True if every probability is positive, which Kullback_Leibler_Distance and
+            Jensen_Shannon_Distance require
+        log_values: log of values, computed on first use and cached
+        entropy: per-column entropy -sum(p * log(p)) (in nats), computed on first use and cached
+    Slicing a PPM by rows (ppm[a:b], ppm[::-1]) returns another PPM without re-validation, any other indexing returns
+    plain numpy data.
+    """
+    __slots__ = ("_values", "_pseudocounts", "_nonzero", "_cache")
+
+    def __init__(self, matrix, pseudocounts = 0.0):
+        """
+        Precondition:
+            matrix: n * 4 matrix of counts or probabilities (n >= 1), each row represents a position, no negative entry
+            pseudocounts: a number, or a 4D vector of per-letter pseudocounts, added to every row before normalization
+        """
+        values = np.array(matrix, dtype = float)
+        assert values.ndim == 2 and values.shape[1] == 4 and len(values) > 0
+        assert (values >= 0).all()
+        values = values + np.asarray(pseudocounts, dtype = float)
+        totals = values.sum(axis = 1, keepdims = True)
+        # every position needs some mass to be normalized
+        assert (totals > 0).all()
+        values = values / totals
+        assert np.isclose(values.sum(axis = 1), 1, rtol = 1e-09, atol = 0).all()
+        self._set(values, pseudocounts, bool((values > 0).all()))
+
+    @classmethod
+    def from_motif(cls, motif, pseudocounts = 0.0):
+        """
+        Build the PPM of a Bio.motifs.Motif object from its counts, equivalent to
+        motif.counts.normalize(pseudocounts = pseudocounts) in the order A, C, G, T.
+        """
+        counts = np.array([motif.counts[letter] for letter in "ACGT"], dtype = float).T
+        return cls(counts, pseudocounts = pseudocounts)
+
+    @classmethod
+    def _trusted(cls, values, pseudocounts, nonzero):
+        # helper constructor for matrices that are already known to be valid (e.g. row slices of a PPM)
+        ppm = cls.__new__(cls)
+        ppm._set(values, pseudocounts, nonzero)
+        return ppm
+
+    def _set(self, values, pseudocounts, nonzero):
+        values.flags.writeable = False
+        object.__setattr__(self, "_values", values)
+        object.__setattr__(self, "_pseudocounts", pseudocounts)
+        object.__setattr__(self, "_nonzero", nonzero)
+        # derived arrays (logs, entropies, ...), filled lazily by cached()
+        object.__setattr__(self, "_cache", {})
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PPM objects are immutable")
+
+    def __reduce__(self):
+        # pickled (e.g. for a process pool) without the cache, which the copy rebuilds on demand
+        return (PPM._trusted, (np.array(self._values), self._pseudocounts, self._nonzero))
+
+    @property
+    def values(self):
+        return self._values
+
+    @property
+    def pseudocounts(self):
+        return self._pseudocounts
+
+    @property
+    def nonzero(self):
+        return self._nonzero
+
+    @property
+    def log_values(self):
+        assert self._nonzero
+        return self.cached("log", np.log)
+
+    @property
+    def entropy(self):
+        return self.cached("entropy", lambda values: -np.sum(values * self.log_values, axis = -1))
+
+    def cached(self, key, compute):
+        """
+        Return compute(values), computing it only the first time [key] is asked for. As the matrix can not change,
+        anything derived from it can be stored with the motif and reused by every comparison it takes part in.
+        The returned arrays are read-only.
+        """
+        if key not in self._cache:
+            result = compute(self._values)
+            if isinstance(result, np.ndarray):
+                result.flags.writeable = False
+            self._cache[key] = result
+        return self._cache[key]
+
+    def reverse_complement(self):
+        """
+        Return the PPM of the opposite strand: the positions in reverse order, with A <-> T and C <-> G swapped (the
+        columns in reverse order, as they are stored A, C, G, T). Computed on first use and cached, so the reverse
+        strand keeps its own cache of derived arrays.
+        """
+        def build(values):
+            pseudocounts = self._pseudocounts
+            if np.ndim(pseudocounts) == 1:
+                pseudocounts = np.asarray(pseudocounts)[::-1]
+            return PPM._trusted(np.ascontiguousarray(values[::-1, ::-1]), pseudocounts, self._nonzero)
+        return self.cached("reverse_complement", build)
+
+    @property
+    def shape(self):
+        return self._values.shape
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            values = self._values[key]
+            # a row slice keeps every invariant except non-emptiness
+            if len(values) > 0:
+                return PPM._trusted(values, self._pseudocounts, self._nonzero or bool((values > 0).all()))
+            return values
+        return self._values[key]
+
+    def __array__(self, dtype = None, copy = None):
+        if copy:
+            return np.array(self._values, dtype = dtype)
+        if dtype is None:
+            return self._values
+        return self._values.astype(dtype)
+
+    def __repr__(self):
+        return "PPM(length=%d, pseudocounts=%r)" % (len(self), self._pseudocounts)
+
+
+class PPMLibrary(object):
+    """
+    A fixed collection of PPM objects stored as one padded tensor, for comparing a query against all of them at once.
+    Attributes:
+        ppms: tuple of the PPM objects, in order
+        lengths: int numpy array, the length of every motif
+        tensor: read-only N * Lmax * 4 numpy array, motif n in tensor[n, :lengths[n]], the padding rows are uniform
+            columns so that every row is a valid probability vector
+        mask: read-only N * Lmax boolean numpy array, True at the real positions
+        columns: the tensor flattened to a (N * Lmax) * 4 PPM, through which the column distances of the whole library
+            are computed (and their prepared forms cached) in one call
+    """
+    __slots__ = ("ppms", "lengths", "tensor", "mask", "columns")
+
+    def __init__(self, ppms):
+        """
+        Precondition:
+            ppms: non-empty list of validated PPM objects, or of matrices accepted by PPM
+        """
+        ppms = tuple(ppm if isinstance(ppm, PPM) else PPM(ppm) for ppm in ppms)
+        assert len(ppms) > 0
+        lengths = np.array([len(ppm) for ppm in ppms])
+        tensor = np.full((len(ppms), lengths.max(), 4), 0.25)
+        for n, ppm in enumerate(ppms):
+            tensor[n, :lengths[n]] = ppm.values
+        mask = np.arange(lengths.max()) < lengths[:, None]
+        lengths.flags.writeable = False
+        mask.flags.writeable = False
+        nonzero = all(ppm.nonzero for ppm in ppms)
+        self.ppms = ppms
+        self.lengths = lengths
+        self.columns = PPM._trusted(tensor.reshape(-1, 4), 0.0, nonzero)
+        # shares its memory with columns, which is read-only
+        self.tensor = self.columns.values.reshape(tensor.shape)
+        self.mask = mask
+
+    def __len__(self):
+        return len(self.ppms)
+
+    def __getitem__(self, n):
+        return self.ppms[n]
+
+    def __iter__(self):
+        return iter(self.ppms)
+
+    def __repr__(self):
+        return "PPMLibrary(motifs=%d, max_length=%d)" % (len(self), self.tensor.shape[1])
+
+
+class PPMStore(object):
+    """
+    The PPMs of a whole motif set, converted and validated once: all the columns of all the motifs are stored in one
+    contiguous (total length) * 4 PPM, and every motif is a row slice of it (a PPM sharing that memory, so the derived
+    arrays cached on it are shared by every module using the store).
+    Attributes:
+        ids: list of the motif ids, in order
+        index: dict motif id -> position of the motif in ids
+        columns: the PPM of all the columns, motif n in columns[offsets[n]:offsets[n] + lengths[n]]
+        offsets: read-only int numpy array, the first column of every motif
+        lengths: read-only int numpy array, the length of every motif
+        ppms: tuple of the PPM of every motif, in order
+    """
+    __slots__ = ("ids", "index", "columns", "offsets", "lengths", "ppms")
+
+    def __init__(self, ids, columns, lengths):
+        """
+        Precondition:
+            ids: non-empty list of distinct motif ids
+            columns: a validated PPM of all the columns, motif after motif
+            lengths: positive integers, the length of every motif, summing up to len(columns)
+        """
+        lengths = np.array(lengths, dtype = int)
+        assert len(ids) == len(lengths) > 0 and (lengths > 0).all() and lengths.sum() == len(columns)
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        lengths.flags.writeable = False
+        offsets.flags.writeable = False
+        self.ids = list(ids)
+        self.index = {motif_id: n for n, motif_id in enumerate(self.ids)}
+        assert len(self.index) == len(self.ids)
+        self.columns = columns
+        self.offsets = offsets
+        self.lengths = lengths
+        self.ppms = tuple(columns[start:start + length] for start, length in zip(offsets, lengths))
+
+    @classmethod
+    def from_motifs(cls, motifs, pseudocounts = 0.0):
+        """
+        Build the store of a dict motif id -> Bio.motifs.Motif (e.g. DNABindingMotifs.mmm), every motif as
+        PPM.from_motif(motif, pseudocounts) would build it, but normalized and validated in a single pass.
+        """
+        counts = [np.array([motif.counts[letter] for letter in "ACGT"], dtype = float).T for motif in motifs.values()]
+        return cls(list(motifs.keys()), PPM(np.concatenate(counts), pseudocounts = pseudocounts),
+                   [len(count) for count in counts])
+
+    @classmethod
+    def of(cls, dataset, pseudocounts = 0.0):
+        """
+        Return the store of the motifs of [dataset] (an object with a motif id -> Bio.motifs.Motif map dataset.mmm),
+        built on the first call and kept on the dataset for every later call with the same pseudocounts.
+        It is rebuilt if the motif ids of dataset.mmm have changed since.
+        Precondition:
+            pseudocounts: a number
+        """
+        stores = dataset.__dict__.setdefault("_ppm_stores", {})
+        store = stores.get(pseudocounts)
+        if store is None or store.ids != list(dataset.mmm.keys()):
+            store = stores[pseudocounts] = cls.from_motifs(dataset.mmm, pseudocounts = pseudocounts)
+        return store
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, motif_id):
+        return motif_id in self.index
+
+    def __getitem__(self, motif_id):
+        return self.ppms[self.index[motif_id]]
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __repr__(self):
+        return "PPMStore(motifs=%d, columns=%d, pseudocounts=%r)" % (len(self), len(self.columns),
+                                                                      self.columns.pseudocounts)
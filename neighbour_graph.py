@@ -0,0 +1,87 @@
+# This module builds a sparse motif graph instead of the dense motif-motif distance matrix.
+# Most pairs of a large motif set are unrelated and never used by the clustering, so only the edges to the nearest
+# neighbours (and/or the neighbours within a distance cutoff) are kept, in a scipy CSR matrix. The alignments use the
+# early-abandoning motif_distance.distance_bounded, so a pair that can not be a kept edge is rejected after a few
+# column comparisons.
+
+import heapq
+
+import numpy as np
+from scipy import sparse
+
+import motif_distance
+from motif_index import candidate_pairs
+from motif_matrix import PPMStore
+
+
+def neighbour_graph(dataset, col_dist, align_method = "expand", bg = [0.25,0.25,0.25,0.25], k = None, cutoff = None,
+                    block = 4, candidates = None):
+    """
+    Return (graph, motif ids): a symmetric scipy.sparse.csr_matrix whose entry (i, j) is the distance between motifs i
+    and j (as computed by dist_from_col.calculate_distance_matrix with average = np.mean) if j is one of the [k]
+    nearest neighbours of i or i one of the [k] nearest neighbours of j, and only if that distance is <= [cutoff].
+    With k = None every pair within the cutoff is an edge. Edges of distance 0 are stored explicitly, absent entries
+    mean "not related".
+    Every pair is aligned with motif_distance.distance_bounded, with the largest distance that could still make it an
+    edge of either motif as its cutoff (the cutoff, or the distance of the current k-th nearest neighbour).
+    Preconditions:
+        col_dist: returns a non-negative numerical distance value based on two input 4D vectors
+        align_method: ["expand","overlap"]
+        bg: background frequency, represented by 4-D vectors that should sum to 1 (only "expand" will use it)
+        k: None or a positive integer
+        cutoff: None or a number; k and cutoff are not both None
+        block: positive integer, the number of columns scored at a time (see motif_distance.bounded_sweep)
+        candidates: None (every pair is aligned), or one iterable of candidate neighbours per motif, as indices in the
+            motif order (e.g. motif_index.MotifIndex.from_dataset(dataset).all_candidates(m)); only the candidate pairs
+            are aligned, so the graph is approximate (see motif_index.recall_at_k)
+    """
+    assert k is not None or cutoff is not None
+    assert k is None or k > 0
+    ppm_store = PPMStore.of(dataset, pseudocounts = 0.5)
+    ppms = ppm_store.ppms
+    motif_ids = list(ppm_store.ids)
+    n = len(ppms)
+    limit = np.inf if cutoff is None else cutoff
+    # neighbours[i] holds (-distance, -j) for the best neighbours j of motif i found so far, a max-heap on distance
+    neighbours = [[] for _ in range(n)]
+
+    def bound(i):
+        # the largest distance that can still make a neighbour of motif i
+        if k is not None and len(neighbours[i]) == k:
+            return min(limit, -neighbours[i][0][0])
+        return limit
+
+    def offer(i, j, distance):
+        if k is None:
+            neighbours[i].append((-distance, -j))
+        elif len(neighbours[i]) < k:
+            heapq.heappush(neighbours[i], (-distance, -j))
+        elif distance < -neighbours[i][0][0]:
+            heapq.heapreplace(neighbours[i], (-distance, -j))
+
+    if candidates is None:
+        pairs = ((i, j) for i in range(n) for j in range(i + 1, n))
+    else:
+        assert len(candidates) == n
+        pairs = candidate_pairs(candidates)
+
+    for i, j in pairs:
+        pair_cutoff = max(bound(i), bound(j))
+        distance, _, _ = motif_distance.distance_bounded(col_dist, ppms[i], ppms[j], align_method, bg = bg,
+                                                         cutoff = None if pair_cutoff == np.inf else pair_cutoff,
+                                                         block = block)
+        # the "expand" fallback to the mean over all offsets is exact even above the cutoff
+        if distance <= limit:
+            if distance <= bound(i):
+                offer(i, j, distance)
+            if distance <= bound(j):
+                offer(j, i, distance)
+
+    edges = {}
+    for i in range(n):
+        for negative_distance, negative_j in neighbours[i]:
+            edges[min(i, -negative_j), max(i, -negative_j)] = -negative_distance
+    rows = np.array([i for i, j in edges] + [j for i, j in edges], dtype = int)
+    cols = np.array([j for i, j in edges] + [i for i, j in edges], dtype = int)
+    data = np.array(list(edges.values()) * 2, dtype = float)
+    return sparse.csr_matrix((data, (rows, cols)), shape = (n, n)), motif_ids